@@ -29,15 +29,19 @@
     'assets': {
         'web.assets_backend': [
             'dingtalk/static/src/js/ding_qrcode_widget.js',
+            'dingtalk/static/src/js/ding_sync_progress.js',
         ]
     },
 
     # always loaded
     'data': [
         'security/ir.model.access.csv',
+        'data/ir_cron.xml',
         'views/company.xml',
         'views/app.xml',
         'views/log.xml',
+        'views/callback_event.xml',
+        'views/message.xml',
     ],
     # only loaded in demonstration mode
     'application': True,
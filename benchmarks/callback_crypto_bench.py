@@ -0,0 +1,56 @@
+"""
+micro benchmark of Dingtalk callback encrypt + decrypt, it runs on every callback request
+
+usage: python benchmarks/callback_crypto_bench.py [--number 20000]
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'common'))
+
+from DingCallbackCrypto import DingCallbackCrypto3  # noqa: E402
+
+TOKEN = 'mryue'
+AES_KEY = 'Yue0EfdN5900c1ce5cf6A152c63DDe1808a60c5ecd7'
+CORP_ID = 'ding6ccabc44d2c8d38b'
+
+PAYLOADS = {
+    'check_url': json.dumps({'EventType': 'check_url'}),
+    'user_modify_org': json.dumps({
+        'EventType': 'user_modify_org', 'TimeStamp': '1608001896814', 'CorpId': CORP_ID,
+        'UserId': [f'user{i:04d}' for i in range(20)]
+    }),
+    'multibyte': json.dumps({'EventType': 'org_dept_modify', 'DeptId': [1, 2, 3], 'Name': '研发中心-平台组'},
+                            ensure_ascii=False),
+}
+
+
+def bench(number):
+    results = {}
+    for name, payload in PAYLOADS.items():
+        def _round_trip():
+            crypto = DingCallbackCrypto3(TOKEN, AES_KEY, CORP_ID)
+            encrypted = crypto.getEncryptedMap(payload)
+            crypto.getDecryptMsg(encrypted['msg_signature'], encrypted['timeStamp'], encrypted['nonce'],
+                                 encrypted['encrypt'])
+
+        _round_trip()
+        seconds = min(timeit.repeat(_round_trip, number=number, repeat=3))
+        results[name] = {
+            'bytes': len(payload.encode('utf-8')),
+            'us_per_event': round(seconds / number * 1e6, 2),
+            'events_per_second': round(number / seconds)
+        }
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--number', type=int, default=20000, help='round trips of each payload')
+    args = parser.parse_args()
+    for name, result in bench(args.number).items():
+        print(f"{name:<16} {result['bytes']:>5} bytes  {result['us_per_event']:>8} us/event  "
+              f"{result['events_per_second']:>8} events/s")
@@ -0,0 +1,287 @@
+"""
+local stand-in of Dingtalk server with a synthetic organization, used to benchmark sync without a real tenant
+
+usage: python benchmarks/fake_dingtalk.py [--depth 3] [--fanout 5] [--users-per-dept 20] [--port 8089]
+then point DingRequest.url_prefix and DingRequest.new_url_prefix to http://127.0.0.1:8089
+"""
+import argparse
+import asyncio
+import random
+import threading
+import time
+from collections import Counter
+
+from aiohttp import web
+
+TITLES = ['Engineer', 'Senior Engineer', 'Manager', 'Designer', 'Analyst', 'Sales', 'Support', None]
+
+
+class FakeOrg(object):
+    """
+    synthetic organization, department 1 is the root like Dingtalk
+    """
+
+    def __init__(self, depth=3, fanout=5, users_per_dept=20, multi_dept_ratio=0.1, seed=0):
+        """
+        :param depth: levels of departments under root
+        :param fanout: sub departments of each department
+        :param users_per_dept: users whose main department is each department
+        :param multi_dept_ratio: ratio of users who are also in another department
+        :param seed: random seed, the same seed generates the same organization
+        """
+        rnd = random.Random(seed)
+        self.departments = {1: {'dept_id': 1, 'name': 'Root', 'order': 0}}
+        self.children = {1: []}
+        level = [1]
+        for _ in range(depth):
+            next_level = []
+            for parent_id in level:
+                for order in range(fanout):
+                    dept_id = len(self.departments) + 1
+                    self.departments[dept_id] = {
+                        'dept_id': dept_id,
+                        'name': f'Department {dept_id}',
+                        'parent_id': parent_id,
+                        'order': order
+                    }
+                    self.children[parent_id].append(dept_id)
+                    self.children[dept_id] = []
+                    next_level.append(dept_id)
+            level = next_level
+
+        dept_ids = list(self.departments)
+        self.users = {}
+        self.dept_users = {dept_id: [] for dept_id in dept_ids}
+        for dept_id in dept_ids:
+            for i in range(users_per_dept):
+                n = len(self.users) + 1
+                dept_id_list = [dept_id]
+                if len(dept_ids) > 1 and rnd.random() < multi_dept_ratio:
+                    other_id = rnd.choice(dept_ids)
+                    if other_id != dept_id:
+                        dept_id_list.append(other_id)
+                user = {
+                    'userid': f'user{n:06d}',
+                    'unionid': f'union{n:06d}',
+                    'name': f'User {n}',
+                    'title': rnd.choice(TITLES),
+                    'email': f'user{n}@example.com',
+                    'mobile': f'138{n:08d}',
+                    'active': True,
+                    'dept_id_list': dept_id_list,
+                    # the first user of each department is its leader
+                    'leader_in_dept': [{'dept_id': dept_id, 'leader': i == 0}]
+                }
+                self.users[user['userid']] = user
+                for user_dept_id in dept_id_list:
+                    self.dept_users[user_dept_id].append(user['userid'])
+
+    def list_user(self, userid, dept_id):
+        user = self.users[userid]
+        return dict(user, leader=any(
+            leader['dept_id'] == dept_id and leader['leader'] for leader in user['leader_in_dept']))
+
+    def shape(self):
+        return {
+            'departments': len(self.departments),
+            'users': len(self.users),
+            'memberships': sum(len(userids) for userids in self.dept_users.values())
+        }
+
+
+class FakeDingtalkServer(object):
+    """
+    aiohttp server of a FakeOrg, it runs in its own thread and event loop, so the process under benchmark
+    only talks to it over http like to Dingtalk
+    """
+
+    def __init__(self, org, latency=0.0, qps=None, host='127.0.0.1', port=0):
+        """
+        :param org: FakeOrg
+        :param latency: seconds added to every response, to simulate network round trip
+        :param qps: requests per second, requests over it are answered with errcode 90018 like Dingtalk
+        :param host: listen host
+        :param port: listen port, 0 is any free port
+        """
+        self.org = org
+        self.latency = latency
+        self.qps = qps
+        self.host = host
+        self.port = port
+        # requests of each path, reset by callers between runs
+        self.calls = Counter()
+        self.throttled = 0
+        self.messages = {}
+        self._window = (0, 0)
+        self._loop = None
+        self._runner = None
+        self._thread = None
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}'
+
+    def _build_app(self):
+        app = web.Application(middlewares=[self._middleware])
+        app.router.add_get('/gettoken', self.get_token)
+        app.router.add_get('/auth/scopes', self.auth_scopes)
+        app.router.add_post('/topapi/v2/department/listsubid', self.department_listsubid)
+        app.router.add_post('/topapi/v2/department/listsub', self.department_listsub)
+        app.router.add_post('/topapi/v2/department/get', self.department_get)
+        app.router.add_post('/topapi/v2/user/list', self.user_list)
+        app.router.add_post('/topapi/v2/user/get', self.user_get)
+        app.router.add_post('/topapi/message/corpconversation/asyncsend_v2', self.message_send)
+        app.router.add_post('/topapi/message/corpconversation/getsendprogress', self.message_progress)
+        app.router.add_post('/topapi/message/corpconversation/getsendresult', self.message_result)
+        return app
+
+    @web.middleware
+    async def _middleware(self, request, handler):
+        self.calls[request.path] += 1
+        if self.qps:
+            second = int(time.monotonic())
+            window_second, count = self._window
+            count = count + 1 if window_second == second else 1
+            self._window = (second, count)
+            if count > self.qps:
+                self.throttled += 1
+                return web.json_response({'errcode': 90018, 'errmsg': 'qps limit'})
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return await handler(request)
+
+    @staticmethod
+    def ok(**kwargs):
+        return web.json_response(dict(errcode=0, errmsg='ok', **kwargs))
+
+    async def get_token(self, request):
+        return self.ok(access_token='fake-token', expires_in=7200)
+
+    async def auth_scopes(self, request):
+        return self.ok(auth_user_field=['name', 'mobile', 'email'],
+                       auth_org_scopes={'authed_dept': [1], 'authed_user': []})
+
+    async def department_listsubid(self, request):
+        data = await request.json()
+        return self.ok(result={'dept_id_list': self.org.children.get(int(data['dept_id'] or 1), [])})
+
+    async def department_listsub(self, request):
+        data = await request.json()
+        # like Dingtalk, listing has no order
+        return self.ok(result=[{key: value for key, value in self.org.departments[dept_id].items() if key != 'order'}
+                               for dept_id in self.org.children.get(int(data['dept_id'] or 1), [])])
+
+    async def department_get(self, request):
+        data = await request.json()
+        department = self.org.departments.get(int(data['dept_id']))
+        if department is None:
+            return web.json_response({'errcode': 60003, 'errmsg': 'department not found'})
+        return self.ok(result=department)
+
+    async def user_list(self, request):
+        data = await request.json()
+        dept_id = int(data['dept_id'])
+        cursor, size = int(data.get('cursor') or 0), int(data.get('size') or 100)
+        userids = self.org.dept_users.get(dept_id, [])
+        result = {
+            'has_more': cursor + size < len(userids),
+            'list': [self.org.list_user(userid, dept_id) for userid in userids[cursor:cursor + size]]
+        }
+        if result['has_more']:
+            result['next_cursor'] = cursor + size
+        return self.ok(result=result)
+
+    async def user_get(self, request):
+        data = await request.json()
+        user = self.org.users.get(data['userid'])
+        if user is None:
+            return web.json_response({'errcode': 60121, 'errmsg': 'user not found'})
+        return self.ok(result=user)
+
+    async def message_send(self, request):
+        data = await request.json()
+        userids = [userid for userid in (data.get('userid_list') or '').split(',') if userid]
+        dept_ids = [dept_id for dept_id in (data.get('dept_id_list') or '').split(',') if dept_id]
+        # the same limits as Dingtalk asyncsend_v2
+        if len(userids) > 100 or len(dept_ids) > 20:
+            return web.json_response({'errcode': 40035, 'errmsg': 'too many receivers'})
+        task_id = len(self.messages) + 1
+        self.messages[task_id] = userids
+        return self.ok(request_id=f'request{task_id}', task_id=task_id)
+
+    async def message_progress(self, request):
+        data = await request.json()
+        return self.ok(progress={'status': 2, 'progress_in_percent': 100} if int(data['task_id']) in self.messages
+                       else {'status': 0, 'progress_in_percent': 0})
+
+    async def message_result(self, request):
+        data = await request.json()
+        return self.ok(send_result={'read_user_id_list': self.messages.get(int(data['task_id']), [])})
+
+    async def _start(self, ready):
+        self._runner = web.AppRunner(self._build_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        ready.set()
+
+    def _run(self, ready):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self._start(ready))
+        self._loop.run_forever()
+
+    def start(self):
+        """
+        start server in a daemon thread and wait until it listens
+        :return: self
+        """
+        self._loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(ready,), name='fake-dingtalk', daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result(5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(5)
+
+    def reset(self):
+        self.calls.clear()
+        self.throttled = 0
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def add_org_arguments(parser):
+    parser.add_argument('--depth', type=int, default=3, help='levels of departments under root')
+    parser.add_argument('--fanout', type=int, default=5, help='sub departments of each department')
+    parser.add_argument('--users-per-dept', type=int, default=20)
+    parser.add_argument('--multi-dept-ratio', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--qps', type=int, default=None, help='throttle requests over it like Dingtalk')
+
+
+def org_from_args(args):
+    return FakeOrg(args.depth, args.fanout, args.users_per_dept, args.multi_dept_ratio, args.seed)
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_org_arguments(arg_parser)
+    arg_parser.add_argument('--port', type=int, default=8089)
+    cli_args = arg_parser.parse_args()
+    fake_org = org_from_args(cli_args)
+    server = FakeDingtalkServer(fake_org, cli_args.latency, cli_args.qps, port=cli_args.port).start()
+    print(f'fake Dingtalk server of {fake_org.shape()} listens on {server.url}, press ctrl+c to stop')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,279 @@
+"""
+benchmark of organization sync against a local fake Dingtalk server, no real tenant is needed
+
+api mode only walks the organization with DingRequest, it needs no odoo:
+    python benchmarks/sync_bench.py api --depth 3 --fanout 5 --users-per-dept 20
+
+odoo mode runs dingtalk.app.sync_ding_organization twice (first sync and sync without changes) and then the
+callback event path, the module must be installed in the database, and records are written, so use a
+throwaway database:
+    python benchmarks/sync_bench.py odoo -c odoo.conf -d bench_db --callback-events 200
+
+results are compared with a saved baseline, a metric which is worse than --threshold makes the exit code 1:
+    python benchmarks/sync_bench.py api --save-baseline benchmarks/baselines/api.json
+    python benchmarks/sync_bench.py api --baseline benchmarks/baselines/api.json
+
+benchmarks/baselines/api.json is the baseline of the default shape, timings depend on the machine, so compare
+api_calls everywhere and timings only with a baseline saved on the same machine
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+from fake_dingtalk import FakeDingtalkServer, add_org_arguments, org_from_args  # noqa: E402
+
+# metrics where lower is better, others are only reported
+LOWER_IS_BETTER = ('seconds', 'api_calls', 'queries', 'peak_memory_mb')
+
+
+def patch_ding_request(ding_request_module, token_store_module, url):
+    """
+    point DingRequest to the fake server, token is kept in memory so benchmark runs do not share it
+    """
+    ding_request_module.DingRequest.url_prefix = url
+    ding_request_module.DingRequest.new_url_prefix = url
+    ding_request_module.DingRequest.token_store_class = token_store_module.TokenStore
+    ding_request_module.ding_request_cache.clear()
+
+
+class MemoryProbe(object):
+    """
+    peak memory of a block, tracemalloc is exact for python objects but slows code down, so it is optional
+    and peak rss of the process is used otherwise
+    """
+
+    def __init__(self, use_tracemalloc, peak_memory):
+        self.use_tracemalloc = use_tracemalloc
+        self.peak_memory = peak_memory
+        self.peak_mb = 0
+
+    def __enter__(self):
+        if self.use_tracemalloc:
+            tracemalloc.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.use_tracemalloc:
+            self.peak_mb = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 2)
+            tracemalloc.stop()
+        else:
+            self.peak_mb = self.peak_memory()
+
+
+def bench_api(args, server):
+    """
+    walk the organization like sync does, without writing anything
+    """
+    sys.path.insert(0, os.path.dirname(BENCH_DIR))
+    from common import ding_request as ding_request_module
+    from common.metrics import SyncMetrics, peak_memory
+    from common.store import token_store as token_store_module
+
+    patch_ding_request(ding_request_module, token_store_module, server.url)
+    ding_request = ding_request_module.ding_request_instance('bench-key', 'bench-secret', 'bench')
+
+    async def _walk():
+        auth_scopes = await ding_request.get_auth_scopes()
+
+        async def _users(dept_id):
+            count = 0
+            async for user_list in ding_request.iter_department_users(dept_id):
+                count += len(user_list)
+            return count
+
+        # the same discovery as sync, users of a department are fetched as soon as it is discovered
+        tasks = []
+        async for detail in ding_request.iter_department_tree(auth_scopes['auth_org_scopes']['authed_dept'],
+                                                              detail_fields=args.detail_fields):
+            tasks.append(asyncio.ensure_future(_users(detail['dept_id'])))
+        memberships = sum(await asyncio.gather(*tasks))
+        await ding_request.close()
+        return len(tasks), memberships
+
+    async def _run():
+        with sync_metrics.activate():
+            return await _walk()
+
+    results = {}
+    for scenario in ('cold', 'warm'):
+        if scenario == 'cold':
+            ding_request.invalidate_cache()
+        server.reset()
+        sync_metrics = SyncMetrics()
+        with MemoryProbe(args.tracemalloc, peak_memory) as probe:
+            started = time.perf_counter()
+            departments, memberships = asyncio.run(_run())
+            seconds = time.perf_counter() - started
+        results[f'api_{scenario}'] = {
+            'seconds': round(seconds, 3),
+            'departments_per_second': round(departments / seconds, 1),
+            'users_per_second': round(memberships / seconds, 1),
+            'api_calls': sum(server.calls.values()),
+            'api_throttles': server.throttled,
+            'api_retries': sync_metrics.counters['api_retries'],
+            'peak_memory_mb': probe.peak_mb
+        }
+    return results
+
+
+def bench_odoo(args, server):
+    """
+    run sync and callback path of the installed module against the fake server
+    """
+    import odoo
+    from odoo import sql_db
+
+    odoo.tools.config.parse_config(['-c', args.config, '-d', args.database])
+    from odoo.addons.dingtalk.common import ding_request as ding_request_module
+    from odoo.addons.dingtalk.common.loop_runner import run_coroutine
+    from odoo.addons.dingtalk.common.metrics import peak_memory
+    from odoo.addons.dingtalk.common.store import token_store as token_store_module
+
+    patch_ding_request(ding_request_module, token_store_module, server.url)
+    registry = odoo.registry(args.database)
+    with registry.cursor() as cr:
+        env = odoo.api.Environment(cr, odoo.SUPERUSER_ID, {})
+        app = env['dingtalk.app'].search([('app_key', '=', 'bench-key')], limit=1) or env['dingtalk.app'].create({
+            'name': 'Benchmark',
+            'agentid': '1',
+            'app_key': 'bench-key',
+            'app_secret': 'bench-secret',
+            'company_id': env.company.id,
+            'sync_with_user': args.sync_with_user
+        })
+        app_id = app.id
+
+    def _measure(name, func):
+        server.reset()
+        queries = sql_db.sql_counter
+        with MemoryProbe(args.tracemalloc, peak_memory) as probe:
+            started = time.perf_counter()
+            func()
+            seconds = time.perf_counter() - started
+        results[name] = {
+            'seconds': round(seconds, 3),
+            'api_calls': sum(server.calls.values()),
+            'api_throttles': server.throttled,
+            'queries': sql_db.sql_counter - queries,
+            'peak_memory_mb': probe.peak_mb
+        }
+        return results[name]
+
+    def _sync():
+        with registry.cursor() as cr:
+            env = odoo.api.Environment(cr, odoo.SUPERUSER_ID, {})
+            run_coroutine(env['dingtalk.app'].browse(app_id).sync_ding_organization())
+
+    results = {}
+    shape = server.org.shape()
+    for name in ('sync_first', 'sync_unchanged'):
+        result = _measure(name, _sync)
+        result['users_per_second'] = round(shape['users'] / result['seconds'], 1)
+        with registry.cursor() as cr:
+            env = odoo.api.Environment(cr, odoo.SUPERUSER_ID, {})
+            log = env['dingtalk.log'].search([('ding_app_id', '=', app_id)], limit=1)
+            result.update(state=log.state, network_time=log.network_time, orm_time=log.orm_time,
+                          employee_created=log.employee_created, employee_updated=log.employee_updated,
+                          employee_skipped=log.employee_skipped)
+
+    if args.callback_events:
+        userids = random.Random(args.seed).sample(list(server.org.users), min(args.callback_events,
+                                                                              len(server.org.users)))
+
+        def _callback():
+            with registry.cursor() as cr:
+                env = odoo.api.Environment(cr, odoo.SUPERUSER_ID, {})
+                app = env['dingtalk.app'].browse(app_id)
+                for userid in userids:
+                    env['dingtalk.callback.event'].enqueue(app, {'EventType': 'user_modify_org', 'UserId': [userid]})
+                cr.commit()
+                env['dingtalk.callback.event'].process_events()
+
+        result = _measure('callback_events', _callback)
+        result['events_per_second'] = round(len(userids) / result['seconds'], 1)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    print results with change to baseline
+    :return: list of regressions
+    """
+    regressions = []
+    for scenario, metrics in results.items():
+        print(scenario)
+        for name, value in metrics.items():
+            base = baseline.get(scenario, {}).get(name)
+            change = ''
+            if isinstance(value, (int, float)) and isinstance(base, (int, float)) and base:
+                ratio = (value - base) / base
+                change = f'{ratio:+.1%}'
+                worse = ratio > threshold if name in LOWER_IS_BETTER else \
+                    name.endswith('_per_second') and ratio < -threshold
+                if worse:
+                    change += '  REGRESSION'
+                    regressions.append(f'{scenario}.{name}')
+            print(f'  {name:<24} {value!s:>12}  {"" if base is None else base!s:>12}  {change}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('mode', choices=['api', 'odoo'])
+    add_org_arguments(parser)
+    parser.add_argument('-c', '--config', help='odoo config file, odoo mode only')
+    parser.add_argument('-d', '--database', help='throwaway database with the module installed, odoo mode only')
+    parser.add_argument('--sync-with-user', action='store_true', help='also create res.users, odoo mode only')
+    parser.add_argument('--detail-fields', type=lambda value: tuple(field for field in value.split(',') if field),
+                        default=(), help='comma separated hr.department ding_detail_fields of the sync, api mode '
+                                         'only, the default is the same as the sync')
+    parser.add_argument('--callback-events', type=int, default=100, help='user_modify_org events, odoo mode only')
+    parser.add_argument('--tracemalloc', action='store_true', help='measure python memory instead of peak rss')
+    parser.add_argument('--baseline', help='json file of baseline results to compare with')
+    parser.add_argument('--save-baseline', help='save results as baseline to the json file')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change reported as regression')
+    parser.add_argument('--json', action='store_true', help='print results as json only')
+    args = parser.parse_args()
+    if args.mode == 'odoo' and not (args.config and args.database):
+        parser.error('odoo mode needs --config and --database')
+
+    org = org_from_args(args)
+    with FakeDingtalkServer(org, args.latency, args.qps) as server:
+        results = bench_api(args, server) if args.mode == 'api' else bench_odoo(args, server)
+    report = {'shape': dict(org.shape(), depth=args.depth, fanout=args.fanout, latency=args.latency,
+                            detail_fields=list(args.detail_fields)),
+              'results': results}
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save_baseline)), exist_ok=True)
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+        return 0
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline_report = json.load(f)
+        if baseline_report.get('shape') != report['shape']:
+            print(f'warning: baseline shape {baseline_report.get("shape")} differs from {report["shape"]}')
+        baseline = baseline_report['results']
+    print(f'organization: {report["shape"]}')
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print(f'regressions over {args.threshold:.0%}: {", ".join(regressions)}')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -11,13 +11,13 @@
 
 
 import base64
-import binascii
+import functools
 import hashlib
-import io
+import hmac
+import random
 import string
 import struct
 import time
-from random import choice
 
 from Crypto.Cipher import AES
 
@@ -29,13 +29,28 @@ from Crypto.Cipher import AES
                       第三方企业应用, 使用suiteKey
 """
 
+RANDOM_CHARS = string.ascii_letters + string.ascii_lowercase + string.ascii_uppercase + string.digits
+BLOCK_SIZE = 32
+
+
+@functools.lru_cache(maxsize=64)
+def decode_aes_key(encodingAesKey):
+    """
+    解码EncodingAESKey, 同一个key只解码一次
+    :param encodingAesKey:
+    :return: (aesKey, iv)
+    """
+    aesKey = base64.b64decode(encodingAesKey + '=')
+    return aesKey, aesKey[:16]
+
 
 class DingCallbackCrypto3:
     def __init__(self, token, encodingAesKey, key):
         self.encodingAesKey = encodingAesKey
         self.key = key
         self.token = token
-        self.aesKey = base64.b64decode(self.encodingAesKey + '=')
+        self.aesKey, self.iv = decode_aes_key(encodingAesKey)
+        self.keyBytes = key.encode('utf-8')
 
     ## 生成回调处理完成后的success加密数据
     def getEncryptedMap(self, content):
@@ -53,88 +68,76 @@ class DingCallbackCrypto3:
         :return:
         """
         sign = self.generateSignature(nonce, timeStamp, self.token, content)
-        if msg_signature != sign:
+        if not hmac.compare_digest(msg_signature, sign):
             raise ValueError('signature check error')
 
-        content = base64.decodebytes(content.encode('UTF-8'))  ##钉钉返回的消息体
-
-        iv = self.aesKey[:16]  ##初始向量
-        aesDecode = AES.new(self.aesKey, AES.MODE_CBC, iv)
-        decodeRes = aesDecode.decrypt(content)
-        # pad = int(binascii.hexlify(decodeRes[-1]),16)
-        pad = int(decodeRes[-1])
-        if pad > 32:
-            raise ValueError('Input is not padded or padding is corrupt')
-        decodeRes = decodeRes[:-pad]
-        l = struct.unpack('!i', decodeRes[16:20])[0]
-        ##获取去除初始向量，四位msg长度以及尾部corpid
-        nl = len(decodeRes)
-
-        if decodeRes[(20 + l):].decode() != self.key:
+        content = base64.b64decode(content)  ##钉钉返回的消息体
+        decodeRes = self.pks7decode(AES.new(self.aesKey, AES.MODE_CBC, self.iv).decrypt(content))
+        ##获取去除16位随机串，四位msg长度以及尾部corpid
+        l = struct.unpack('!I', decodeRes[16:20])[0]
+        if decodeRes[(20 + l):] != self.keyBytes:
             raise ValueError('corpId 校验错误')
-        return decodeRes[20:(20 + l)].decode()
+        return decodeRes[20:(20 + l)].decode('utf-8')
 
     def encrypt(self, content):
         """
-        加密
-        :param content:
+        加密, 长度和填充都按utf-8字节计算, 多字节字符也能正确加密
+        :param content: str or bytes
         :return:
         """
-        msg_len = self.length(content)
-        content = ''.join([self.generateRandomKey(16), msg_len.decode(), content, self.key])
-        contentEncode = self.pks7encode(content)
-        iv = self.aesKey[:16]
-        aesEncode = AES.new(self.aesKey, AES.MODE_CBC, iv)
-        aesEncrypt = aesEncode.encrypt(contentEncode)
-        return base64.encodebytes(aesEncrypt).decode('UTF-8')
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        contentEncode = self.pks7encode(b''.join([
+            self.generateRandomKey(16).encode('ascii'), self.length(content), content, self.keyBytes
+        ]))
+        aesEncrypt = AES.new(self.aesKey, AES.MODE_CBC, self.iv).encrypt(contentEncode)
+        return base64.b64encode(aesEncrypt).decode('ascii')
 
     ### 生成回调返回使用的签名值
     def generateSignature(self, nonce, timestamp, token, msg_encrypt):
-        v = msg_encrypt
-        signList = ''.join(sorted([nonce, timestamp, token, v]))
+        signList = ''.join(sorted([nonce, timestamp, token, msg_encrypt]))
         return hashlib.sha1(signList.encode()).hexdigest()
 
     def length(self, content):
         """
         将msg_len转为符合要求的四位字节长度
-        :param content:
+        :param content: str or bytes, str按utf-8字节计算长度
         :return:
         """
-        l = len(content)
-        return struct.pack('>l', l)
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        return struct.pack('>I', len(content))
 
     def pks7encode(self, content):
         """
-        安装 PKCS#7 标准填充字符串
-        :param text: str
-        :return: str
+        按 PKCS#7 标准填充
+        :param content: bytes, str按utf-8编码
+        :return: bytes
         """
-        l = len(content)
-        output = io.StringIO()
-        val = 32 - (l % 32)
-        for _ in range(val):
-            output.write('%02x' % val)
-        # print "pks7encode",content,"pks7encode", val, "pks7encode", output.getvalue()
-        return content + binascii.unhexlify(output.getvalue()).decode()
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        val = BLOCK_SIZE - (len(content) % BLOCK_SIZE)
+        return content + bytes([val]) * val
 
     def pks7decode(self, content):
-        nl = len(content)
-        val = int(binascii.hexlify(content[-1]), 16)
-        if val > 32:
+        """
+        去除 PKCS#7 填充
+        :param content: bytes
+        :return: bytes
+        """
+        val = content[-1]
+        if val < 1 or val > BLOCK_SIZE:
             raise ValueError('Input is not padded or padding is corrupt')
+        return content[:-val]
 
-        l = nl - val
-        return content[:l]
-
-    def generateRandomKey(self, size,
-                          chars=string.ascii_letters + string.ascii_lowercase + string.ascii_uppercase + string.digits):
+    def generateRandomKey(self, size, chars=RANDOM_CHARS):
         """
         生成加密所需要的随机字符串
         :param size:
         :param chars:
         :return:
         """
-        return ''.join(choice(chars) for i in range(size))
+        return ''.join(random.choices(chars, k=size))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,81 @@
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class TTLCache(object):
+    """
+    thread safe cache with bounded size, the least recently used item is evicted when it is full,
+    and every item expires after its own ttl
+    """
+
+    def __init__(self, maxsize=4096):
+        """
+        :param maxsize: max items in cache
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=MISSING):
+        """
+        get value of key, expired item is removed
+        :param key: hashable key
+        :param default: returned when key is missing or expired
+        :return:
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[1] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value, ttl):
+        """
+        set value of key
+        :param key: hashable key
+        :param value: value, it is shared by all readers and should not be modified
+        :param ttl: seconds the value is valid
+        :return:
+        """
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, *prefix):
+        """
+        remove items whose key starts with prefix, key of cache is a tuple
+        :param prefix: key prefix, remove all items if it is empty
+        :return: removed count
+        """
+        with self._lock:
+            keys = [key for key in self._data if key[:len(prefix)] == prefix]
+            for key in keys:
+                del self._data[key]
+            return len(keys)
+
+    def stats(self):
+        """
+        hit and miss counters used to tune ttl and size
+        :return: dict
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 4) if total else 0,
+                'size': len(self._data),
+                'maxsize': self.maxsize
+            }
@@ -1,10 +1,41 @@
+import asyncio
 import base64
 import hmac
+import os
+import time
+import weakref
 from urllib import parse
 
 import aiohttp
 
-from .store.token_store import TokenStore
+from . import metrics
+from .cache import MISSING, TTLCache
+from .rate_limit import TokenBucket, backoff_delay
+from .store.token_store import FileTokenStore
+
+# system busy and qps limit error codes, requests are retried instead of raised
+THROTTLE_ERROR_CODES = {-1, 90002, 90005, 90006, 90008, 90010, 90018, 90019}
+# department and user not found, the object is removed in Dingtalk
+NOT_FOUND_ERROR_CODES = {60003, 60121}
+
+
+class DingResponseError(Exception):
+    """
+    error response of Dingtalk api
+    """
+
+    def __init__(self, message, errcode=None):
+        super().__init__(message)
+        self.errcode = errcode
+
+
+def is_not_found(error):
+    """
+    check whether the error is raised because the requested department or user does not exist in Dingtalk
+    :param error: exception
+    :return:
+    """
+    return isinstance(error, DingResponseError) and error.errcode in NOT_FOUND_ERROR_CODES
 
 
 def get_sign(data, key):
@@ -20,7 +51,22 @@ def get_sign(data, key):
 
 def check_response_error(response, error_code=0, error_msg_key='errmsg'):
     if response['errcode'] != error_code:
-        raise Exception(response[error_msg_key])
+        raise DingResponseError(response[error_msg_key], response['errcode'])
+
+
+def is_throttled(response):
+    """
+    check whether the response is rejected by Dingtalk qps limit, new api returns code like
+    Forbidden.AccessDenied.QpsLimitForApi instead of errcode
+    :param response: response json
+    :return:
+    """
+    if not isinstance(response, dict):
+        return False
+    if response.get('errcode') in THROTTLE_ERROR_CODES:
+        return True
+    code = response.get('code')
+    return isinstance(code, str) and ('QpsLimit' in code or 'Throttling' in code)
 
 
 def join_url(base_url, *args):
@@ -31,37 +77,245 @@ def join_url(base_url, *args):
 
 class DingRequest(object):
     url_prefix = 'https://oapi.dingtalk.com'
+    new_url_prefix = 'https://api.dingtalk.com'
+
+    # connection pool settings of the shared session
+    pool_limit = 100
+    pool_limit_per_host = 30
+    keepalive_timeout = 60
+    dns_cache_ttl = 300
+    request_timeout = 30
+    upload_timeout = 600
+    # refresh token before it expires, unit is second
+    token_refresh_margin = 300
+
+    # token store shared by all workers on the node, set to TokenStore to keep token in process memory
+    token_store_class = FileTokenStore
+
+    # requests per second of each endpoint group, groups not in the dict use default
+    rate_limits = {
+        'default': 20,
+        'token': 10,
+        'contact': 20,
+        'message': 20,
+        'media': 10,
+    }
+    # max requests in flight of this app
+    max_concurrency = 20
+    # retry times and backoff of throttled requests, unit is second
+    max_retries = 5
+    retry_backoff = 0.5
+    retry_backoff_max = 10
+    # read-through cache of read apis, ttl of each endpoint, unit is second
+    cache_enabled = True
+    cache_size = 4096
+    cache_ttls = {
+        'user_info': 60,
+        'department_detail': 300,
+        'department_listsubid': 300,
+        'department_listsub': 300,
+        'auth_scopes': 600,
+    }
+    # departments fetched concurrently when the department tree is discovered
+    department_tree_concurrency = 10
+    # page size of department users, max size is limited by api
+    department_users_page_size = 100
+    department_users_max_size = 100
 
-    def __init__(self, app_key, app_secret):
+    def __init__(self, app_key, app_secret, store_key=None):
         """
         set Dingtalk app_key and app_secret
         :param app_key: Dingtalk app app_key
         :param app_secret: Dingtalk app app_secret
+        :param store_key: key of token store, default is app_key
         """
         self.app_key = app_key
         self.app_secret = app_secret
-        self.token_store = TokenStore(app_key)
+        self.token_store = self.token_store_class(store_key or app_key)
+        # session and semaphore are bound to event loop, so they are kept for each loop
+        self._sessions = weakref.WeakKeyDictionary()
+        self._semaphores = weakref.WeakKeyDictionary()
+        self._token_task = None
+        self._limiters = {}
+        self.cache = TTLCache(self.cache_size)
+
+    def _new_session(self):
+        """
+        create a pooled session, connections are kept alive and reused by every request of this app
+        :return: aiohttp.ClientSession
+        """
+        conn = aiohttp.TCPConnector(
+            ssl=False,
+            limit=self.pool_limit,
+            limit_per_host=self.pool_limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            ttl_dns_cache=self.dns_cache_ttl,
+            use_dns_cache=True
+        )
+        return aiohttp.ClientSession(
+            connector=conn,
+            timeout=aiohttp.ClientTimeout(total=self.request_timeout),
+            headers={'Accept-Encoding': 'gzip, deflate'}
+        )
 
-    async def refresh_token(self):
+    def get_session(self):
         """
-        refresh token if it expires
+        get the session bound to the running event loop, a session can not be shared between loops,
+        so every loop has its own session
+        :return: aiohttp.ClientSession
+        """
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            session = self._sessions[loop] = self._new_session()
+        return session
+
+    async def close(self):
+        """
+        close the pooled session of the running loop, it will be created again when next request
         :return:
         """
-        current_token = self.token_store.get()
-        if not current_token:
-            token = await self.get_token()
-            self.token_store.save(token['token'], token['expires_in'])
+        session = self._sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None and not session.closed:
+            await session.close()
+
+    def get_limiter(self, group):
+        """
+        get token bucket of the endpoint group
+        :param group: endpoint group
+        :return: TokenBucket
+        """
+        limiter = self._limiters.get(group)
+        if limiter is None:
+            limiter = self._limiters[group] = TokenBucket(self.rate_limits.get(group, self.rate_limits['default']))
+        return limiter
+
+    def _get_semaphore(self):
+        """
+        get semaphore which bounds requests in flight, it is bound to the running event loop like session
+        :return: asyncio.Semaphore
+        """
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        return semaphore
+
+    async def call_api(self, method, url, group='default', retries=None, **kwargs):
+        """
+        request api under the rate limit of group, throttled response cuts the rate of group and is retried
+        with jittered backoff
+        :param method: get or post
+        :param url: request url
+        :param group: endpoint group of rate limit
+        :param retries: max retry times, default is max_retries
+        :param kwargs: params of get_response or post_response
+        :return: response json
+        """
+        request_func = self.get_response if method == 'get' else self.post_response
+        retries = self.max_retries if retries is None else retries
+        limiter = self.get_limiter(group)
+        # token in query is not part of the endpoint name
+        endpoint = parse.urlsplit(url).path
+        attempt = 0
+        while True:
+            await limiter.acquire()
+            async with self._get_semaphore():
+                started = time.monotonic()
+                try:
+                    response = await request_func(url, **kwargs)
+                except Exception:
+                    metrics.observe(endpoint, time.monotonic() - started, error=True)
+                    metrics.incr('api_errors')
+                    raise
+            throttled = is_throttled(response)
+            metrics.observe(endpoint, time.monotonic() - started, error=throttled)
+            if throttled:
+                metrics.incr('api_throttles')
+                limiter.throttled()
+            else:
+                limiter.succeeded()
+            if attempt >= retries or not throttled:
+                return response
+            metrics.incr('api_retries')
+            await asyncio.sleep(backoff_delay(attempt, self.retry_backoff, self.retry_backoff_max))
+            attempt += 1
+
+    async def cached_call(self, endpoint, key, fetch_func):
+        """
+        read-through cache of read api, endpoint without ttl in cache_ttls is not cached
+        :param endpoint: endpoint name in cache_ttls
+        :param key: tuple of request params, the first one should be the object id used to invalidate
+        :param fetch_func: function returns coroutine which fetches the value from server
+        :return: value, it is shared by all callers and should not be modified
+        """
+        ttl = self.cache_ttls.get(endpoint) if self.cache_enabled else None
+        if not ttl:
+            return await fetch_func()
+        # ids from api and callback may be int or str
+        key = tuple(str(item) for item in key)
+        value = self.cache.get((endpoint,) + key)
+        if value is MISSING:
+            metrics.incr('cache_misses')
+            value = await fetch_func()
+            self.cache.set((endpoint,) + key, value, ttl)
+        else:
+            metrics.incr('cache_hits')
+        return value
+
+    def invalidate_cache(self, endpoint=None, *object_ids):
+        """
+        remove cached values, callback events invalidate the objects they change
+        :param endpoint: endpoint name, all endpoints if None
+        :param object_ids: object ids, all objects of endpoint if empty
+        :return:
+        """
+        if endpoint is None:
+            self.cache.invalidate()
+        elif not object_ids:
+            self.cache.invalidate(endpoint)
+        for object_id in object_ids:
+            self.cache.invalidate(endpoint, str(object_id))
+
+    async def _fetch_token(self):
+        """
+        fetch a new token from server and save it to token_store
+        :return:
+        """
+        token = await self.get_token()
+        metrics.incr('token_fetches')
+        self.token_store.save(token['token'], token['expires_in'])
+
+    async def refresh_token(self, force=False):
+        """
+        refresh token if it expires or will expire within token_refresh_margin seconds,
+        concurrent callers wait on the same in-flight fetch instead of each requesting gettoken
+        :param force: fetch a new token even if the current one is still valid
+        :return:
+        """
+        if not force and self.token_store.get(self.token_refresh_margin):
+            return
+        task = self._token_task
+        if task is None or task.done() or task.get_loop() is not asyncio.get_running_loop():
+            task = self._token_task = asyncio.ensure_future(self._fetch_token())
+        # shield the shared fetch, a cancelled caller must not cancel it for the others
+        await asyncio.shield(task)
 
     async def latest_token(self):
         """
-        get latest token
+        get latest token, if the proactive refresh fails, the token which is not expired yet is still used
         :return:
         """
-        await self.refresh_token()
+        try:
+            await self.refresh_token()
+        except Exception:
+            token = self.token_store.get()
+            if token:
+                return token
+            raise
         return self.token_store.get()
 
-    @staticmethod
-    async def get_response(url, params=None, response_callback=None, **kwargs):
+    async def get_response(self, url, params=None, response_callback=None, **kwargs):
         """
         get response from server
         :param url: url join with url_prefix
@@ -69,13 +323,10 @@ class DingRequest(object):
         :param response_callback: response callback function
         :return:
         """
-        conn = aiohttp.TCPConnector(ssl=False)
-        async with aiohttp.ClientSession(connector=conn) as session:
-            async with session.get(url, params=params, **kwargs) as response:
-                return await response_callback(response) if response_callback else await response.json()
+        async with self.get_session().get(url, params=params, **kwargs) as response:
+            return await response_callback(response) if response_callback else await response.json()
 
-    @staticmethod
-    async def post_response(url, json, data=None, response_callback=None, **kwargs):
+    async def post_response(self, url, json, data=None, response_callback=None, **kwargs):
         """
         post response to server, if json is not None, use json, else use data
         :param url: url join with url_prefix
@@ -84,17 +335,15 @@ class DingRequest(object):
         :param response_callback: response callback function
         :return:
         """
-        conn = aiohttp.TCPConnector(ssl=False)
-        async with aiohttp.ClientSession(connector=conn) as session:
-            async with session.post(url, json=json, data=data, **kwargs) as response:
-                return await response_callback(response) if response_callback else await response.json()
+        async with self.get_session().post(url, json=json, data=data, **kwargs) as response:
+            return await response_callback(response) if response_callback else await response.json()
 
     async def get_token(self):
         """
         get token from server
         :return:
         """
-        response = await self.get_response(join_url(self.url_prefix, 'gettoken'), {
+        response = await self.call_api('get', join_url(self.url_prefix, 'gettoken'), 'token', params={
             'appkey': self.app_key,
             'appsecret': self.app_secret
         })
@@ -112,12 +361,13 @@ class DingRequest(object):
         :param temp_auth_code: temporary authorization code
         :return: {"expireIn":7200,"accessToken":"xx","refreshToken":"xx"}
         """
-        response = await self.post_response('https://api.dingtalk.com/v1.0/oauth2/userAccessToken', {
-            "clientSecret": app_secret,
-            "clientId": app_key,
-            "code": temp_auth_code,
-            "grantType": "authorization_code"
-        })
+        response = await self.call_api(
+            'post', join_url(self.new_url_prefix, 'v1.0/oauth2/userAccessToken'), 'token', json={
+                "clientSecret": app_secret,
+                "clientId": app_key,
+                "code": temp_auth_code,
+                "grantType": "authorization_code"
+            })
         if response.get('code') is not None:
             raise Exception(response['message'])
         return response
@@ -129,8 +379,8 @@ class DingRequest(object):
         :param union_id: info whose union_id is this, self is 'me'
         :return:
         """
-        response = await self.get_response(
-            f'https://api.dingtalk.com/v1.0/contact/users/{union_id}',
+        response = await self.call_api(
+            'get', join_url(self.new_url_prefix, f'v1.0/contact/users/{union_id}'), 'contact',
             headers={
                 'x-acs-dingtalk-access-token': user_access_token
             }
@@ -146,28 +396,34 @@ class DingRequest(object):
         :param language zh_CN or en_US
         :return:
         """
-        response = await self.post_response(
-            join_url(self.url_prefix, f'topapi/v2/user/get?access_token={await self.latest_token()}'),
-            {
-                'userid': userid,
-                'language': language
-            }
-        )
-        check_response_error(response)
-        return response['result']
+        async def _fetch():
+            response = await self.call_api(
+                'post', join_url(self.url_prefix, f'topapi/v2/user/get?access_token={await self.latest_token()}'),
+                'contact', json={
+                    'userid': userid,
+                    'language': language
+                }
+            )
+            check_response_error(response)
+            return response['result']
+
+        return await self.cached_call('user_info', (userid, language), _fetch)
 
     async def get_auth_scopes(self):
         """
         get auth scopes
         :return:
         """
-        response = await self.get_response(
-            join_url(self.url_prefix, f'auth/scopes?access_token={await self.latest_token()}'))
-        check_response_error(response)
-        return {
-            'auth_user_field': response['auth_user_field'],
-            'auth_org_scopes': response['auth_org_scopes']
-        }
+        async def _fetch():
+            response = await self.call_api(
+                'get', join_url(self.url_prefix, f'auth/scopes?access_token={await self.latest_token()}'))
+            check_response_error(response)
+            return {
+                'auth_user_field': response['auth_user_field'],
+                'auth_org_scopes': response['auth_org_scopes']
+            }
+
+        return await self.cached_call('auth_scopes', (), _fetch)
 
     async def department_listsubid(self, dept_id=None):
         """
@@ -175,12 +431,35 @@ class DingRequest(object):
         :param dept_id: department id
         :return:
         """
-        response = await self.post_response(
-            join_url(self.url_prefix, f'topapi/v2/department/listsubid?access_token={await self.latest_token()}'), {
-                'dept_id': dept_id
-            })
-        check_response_error(response)
-        return response['result']['dept_id_list']
+        async def _fetch():
+            response = await self.call_api(
+                'post', join_url(self.url_prefix, f'topapi/v2/department/listsubid?access_token={await self.latest_token()}'),
+                'contact', json={
+                    'dept_id': dept_id
+                })
+            check_response_error(response)
+            return response['result']['dept_id_list']
+
+        return await self.cached_call('department_listsubid', (dept_id,), _fetch)
+
+    async def department_listsub(self, dept_id=None, language='zh_CN'):
+        """
+        get sub departments with their dept_id, name and parent_id in one call, order is not included
+        :param dept_id: department id, root department if None
+        :param language: language
+        :return: list of sub department
+        """
+        async def _fetch():
+            response = await self.call_api(
+                'post', join_url(self.url_prefix, f'topapi/v2/department/listsub?access_token={await self.latest_token()}'),
+                'contact', json={
+                    'dept_id': dept_id,
+                    'language': language
+                })
+            check_response_error(response)
+            return response['result']
+
+        return await self.cached_call('department_listsub', (dept_id, language), _fetch)
 
     async def department_detail(self, dept_id, language='zh_CN'):
         """
@@ -190,13 +469,86 @@ class DingRequest(object):
         :return:
         """
         assert dept_id is not None, 'dept_id is required'
-        response = await self.post_response(
-            join_url(self.url_prefix, f'topapi/v2/department/get?access_token={await self.latest_token()}'), {
-                'dept_id': dept_id,
-                'language': language
-            })
-        check_response_error(response)
-        return response['result']
+
+        async def _fetch():
+            response = await self.call_api(
+                'post', join_url(self.url_prefix, f'topapi/v2/department/get?access_token={await self.latest_token()}'),
+                'contact', json={
+                    'dept_id': dept_id,
+                    'language': language
+                })
+            check_response_error(response)
+            return response['result']
+
+        return await self.cached_call('department_detail', (dept_id, language), _fetch)
+
+    async def iter_department_tree(self, dept_ids, concurrency=None, language='zh_CN', detail_fields=()):
+        """
+        discover departments under dept_ids breadth first by a bounded pool of workers, each department is yielded
+        as soon as it is fetched, and a department is always yielded after its parent.
+        sub departments are listed with their name and parent by one department_listsub call of the parent, so
+        department_detail is only called for root departments and for departments whose listing misses one of
+        detail_fields, it is fetched together with the department_listsub call of the department.
+        a listed department has position, its index in the listing of its parent, which is in Dingtalk order
+        :param dept_ids: root department ids, they are yielded too
+        :param concurrency: workers fetching departments, default is department_tree_concurrency
+        :param language: language
+        :param detail_fields: fields required in the yielded department, such as order
+        :return: async iterator of department, it may be shared by cache and should not be modified
+        """
+        concurrency = concurrency or self.department_tree_concurrency
+        work_queue = asyncio.Queue()
+        # bounded, so discovery waits for the consumer instead of holding the whole tree
+        detail_queue = asyncio.Queue(maxsize=concurrency * 10)
+        done = object()
+        seen = set()
+
+        def _discover(departments):
+            for dept_id, listed in departments:
+                if str(dept_id) not in seen:
+                    seen.add(str(dept_id))
+                    work_queue.put_nowait((dept_id, listed))
+
+        async def _worker():
+            while True:
+                dept_id, listed = await work_queue.get()
+                try:
+                    if listed is None or any(field not in listed for field in detail_fields):
+                        detail, children = await asyncio.gather(
+                            self.department_detail(dept_id, language), self.department_listsub(dept_id, language))
+                    else:
+                        detail, children = listed, await self.department_listsub(dept_id, language)
+                    # parent is queued before its children are discovered
+                    await detail_queue.put(detail)
+                    # the cached listing is copied, not modified
+                    _discover((child['dept_id'], dict(child, position=position))
+                              for position, child in enumerate(children))
+                except Exception as e:
+                    await detail_queue.put(e)
+                finally:
+                    work_queue.task_done()
+
+        async def _discover_all():
+            workers = [asyncio.ensure_future(_worker()) for _ in range(concurrency)]
+            try:
+                await work_queue.join()
+                await detail_queue.put(done)
+            finally:
+                for worker in workers:
+                    worker.cancel()
+
+        _discover((dept_id, None) for dept_id in dept_ids)
+        discover_task = asyncio.ensure_future(_discover_all())
+        try:
+            while True:
+                detail = await detail_queue.get()
+                if detail is done:
+                    break
+                if isinstance(detail, Exception):
+                    raise detail
+                yield detail
+        finally:
+            discover_task.cancel()
 
     async def department_users(self, dept_id, cursor=0, size=100, language='zh_CN', contain_access_limit=False):
         """
@@ -209,8 +561,9 @@ class DingRequest(object):
         :return:
         """
         assert dept_id is not None, 'dept_id is required'
-        response = await self.post_response(
-            join_url(self.url_prefix, f'topapi/v2/user/list?access_token={await self.latest_token()}'), {
+        response = await self.call_api(
+            'post', join_url(self.url_prefix, f'topapi/v2/user/list?access_token={await self.latest_token()}'),
+            'contact', json={
                 'dept_id': dept_id,
                 'cursor': cursor,
                 'size': size,
@@ -218,45 +571,146 @@ class DingRequest(object):
                 'contain_access_limit': contain_access_limit
             })
         check_response_error(response)
+        metrics.incr('users_fetched', len(response['result']['list']))
         return response['result']
 
+    async def iter_department_users(self, dept_id, size=None, prefetch=2, **kwargs):
+        """
+        iterate department users page by page, the next page is fetched while the current page is handled,
+        and at most prefetch pages are held in memory
+        :param dept_id: department id
+        :param size: page size, default is department_users_page_size, max is department_users_max_size
+        :param prefetch: max pages fetched ahead
+        :param kwargs: other params of department_users
+        :return: async iterator of user list of each page
+        """
+        size = min(size or self.department_users_page_size, self.department_users_max_size)
+        queue = asyncio.Queue(maxsize=max(prefetch, 1))
+        done = object()
+
+        async def _fetch_pages():
+            try:
+                cursor = 0
+                while cursor is not None:
+                    result = await self.department_users(dept_id, cursor=cursor, size=size, **kwargs)
+                    await queue.put(result['list'])
+                    cursor = result.get('next_cursor', None)
+                await queue.put(done)
+            except Exception as e:
+                await queue.put(e)
+
+        fetch_task = asyncio.ensure_future(_fetch_pages())
+        try:
+            while True:
+                page = await queue.get()
+                if page is done:
+                    break
+                if isinstance(page, Exception):
+                    raise page
+                yield page
+        finally:
+            fetch_task.cancel()
+
     async def upload_media(self, media_type, media_file, filename):
         """
         upload media
         :param media_type: image, voice, video or file
-        :param media_file: media file
+        :param media_file: media file, bytes or binary file object, file object is streamed in chunks
         :param filename: media filename
         :return: media_id
         """
         data = aiohttp.FormData()
         data.add_field('type', media_type)
         data.add_field('media', media_file, filename=filename, content_type='application/octet-stream')
-        response = await self.post_response(
-            join_url(self.url_prefix, f'media/upload?access_token={await self.latest_token()}&type={media_type}'),
-            None, data)
+        # form data can be sent only once, so it is not retried
+        response = await self.call_api(
+            'post', join_url(self.url_prefix, f'media/upload?access_token={await self.latest_token()}&type={media_type}'),
+            'media', retries=0, json=None, data=data, timeout=aiohttp.ClientTimeout(total=self.upload_timeout))
         check_response_error(response)
         return response['media_id']
 
+    async def upload_media_file(self, media_type, path, filename=None):
+        """
+        upload media from file path, file is streamed and not loaded into memory
+        :param media_type: image, voice, video or file
+        :param path: file path
+        :param filename: media filename, default is basename of path
+        :return: media_id
+        """
+        with open(path, 'rb') as media_file:
+            return await self.upload_media(media_type, media_file, filename or os.path.basename(path))
+
     async def send_message(self, message):
         """
         send message
         :param message: message dict
         :return:
         """
-        response = await self.post_response(
-            join_url(self.url_prefix, f'topapi/message/corpconversation/asyncsend_v2?access_token={await self.latest_token()}'), message)
+        response = await self.call_api(
+            'post', join_url(self.url_prefix, f'topapi/message/corpconversation/asyncsend_v2?access_token={await self.latest_token()}'),
+            'message', json=message)
         check_response_error(response)
         return {
             'request_id': response['request_id'],
             'task_id': response['task_id']
         }
 
+    async def message_send_progress(self, agent_id, task_id):
+        """
+        get progress of async message send task
+        :param agent_id: app agent id
+        :param task_id: task id returned by send_message
+        :return: {'status': 0 not start, 1 sending, 2 done, 'progress_in_percent': 100}
+        """
+        response = await self.call_api(
+            'post', join_url(self.url_prefix, f'topapi/message/corpconversation/getsendprogress?access_token={await self.latest_token()}'),
+            'message', json={
+                'agent_id': agent_id,
+                'task_id': task_id
+            })
+        check_response_error(response)
+        return response['progress']
+
+    async def message_send_result(self, agent_id, task_id):
+        """
+        get result of async message send task
+        :param agent_id: app agent id
+        :param task_id: task id returned by send_message
+        :return: dict of read_user_id_list, unread_user_id_list, failed_user_id_list, forbidden_user_id_list,
+        invalid_user_id_list, invalid_dept_id_list and forbidden_list
+        """
+        response = await self.call_api(
+            'post', join_url(self.url_prefix, f'topapi/message/corpconversation/getsendresult?access_token={await self.latest_token()}'),
+            'message', json={
+                'agent_id': agent_id,
+                'task_id': task_id
+            })
+        check_response_error(response)
+        return response['send_result']
+
 
-def ding_request_instance(app_key, app_secret):
+ding_request_cache = {}
+
+
+def ding_request_instance(app_key, app_secret, db_name=None):
     """
-    if you want to use custom DingRequest class or Store class, you can set monkey patch to this function
+    if you want to use custom DingRequest class or Store class, you can set monkey patch to this function.
+    the instance is cached by app_key, so its pooled session is reused by every caller of the same app
     :param app_key:
     :param app_secret:
+    :param db_name: database name, used to separate tokens of the same app in different databases
+    :return:
+    """
+    cache_key = f'{db_name}:{app_key}' if db_name else app_key
+    ding_request = ding_request_cache.get(cache_key)
+    if ding_request is None or ding_request.app_secret != app_secret:
+        ding_request = ding_request_cache[cache_key] = DingRequest(app_key, app_secret, cache_key)
+    return ding_request
+
+
+async def close_all_sessions():
+    """
+    close pooled sessions of all cached DingRequest instances in the running loop
     :return:
     """
-    return DingRequest(app_key, app_secret)
+    await asyncio.gather(*[ding_request.close() for ding_request in list(ding_request_cache.values())])
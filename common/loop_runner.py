@@ -0,0 +1,122 @@
+import asyncio
+import atexit
+import concurrent.futures
+import os
+import threading
+
+
+class LoopRunner(object):
+    """
+    a long-lived event loop running in a daemon thread, sync code submits coroutines to it, so connection pools
+    and locks bound to the loop are reused by every call of the process
+    """
+
+    def __init__(self, name='dingtalk-loop'):
+        self.name = name
+        self._loop = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _run_forever(self, loop, ready):
+        asyncio.set_event_loop(loop)
+        ready.set()
+        try:
+            loop.run_forever()
+        finally:
+            loop.close()
+
+    def get_loop(self):
+        """
+        get the running loop, start it if not started, a forked worker process starts its own loop
+        :return: asyncio event loop
+        """
+        with self._lock:
+            if self._loop is None or self._pid != os.getpid() or not self._thread.is_alive():
+                loop = asyncio.new_event_loop()
+                ready = threading.Event()
+                self._thread = threading.Thread(target=self._run_forever, args=(loop, ready), name=self.name,
+                                                daemon=True)
+                self._thread.start()
+                ready.wait()
+                self._loop = loop
+                self._pid = os.getpid()
+            return self._loop
+
+    def submit(self, coroutine):
+        """
+        submit coroutine to the loop without waiting
+        :param coroutine: coroutine object
+        :return: concurrent.futures.Future
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.get_loop())
+
+    def run(self, coroutine, timeout=None):
+        """
+        run coroutine in the loop and wait for the result, the coroutine is cancelled when timeout
+        :param coroutine: coroutine object
+        :param timeout: seconds to wait, None is no limit
+        :return: result of coroutine
+        """
+        if threading.current_thread() is self._thread:
+            coroutine.close()
+            raise RuntimeError('can not wait for a coroutine in its own loop thread')
+        future = self.submit(coroutine)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    def shutdown(self, timeout=5):
+        """
+        close pooled sessions created in the loop and stop the loop
+        :param timeout: seconds to wait for sessions closed
+        :return:
+        """
+        from .ding_request import close_all_sessions
+
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = self._thread = None
+        if loop is None or self._pid != os.getpid() or not thread.is_alive():
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(close_all_sessions(), loop).result(timeout)
+        except Exception:
+            pass
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout)
+
+
+runners = {}
+runners_lock = threading.Lock()
+
+
+def get_runner(name='default'):
+    """
+    get runner by name, the default runner is shared by all sync callers in the process
+    :param name: runner name
+    :return: LoopRunner
+    """
+    with runners_lock:
+        runner = runners.get(name)
+        if runner is None:
+            runner = runners[name] = LoopRunner(f'dingtalk-loop-{name}')
+        return runner
+
+
+def run_coroutine(coroutine, timeout=None):
+    """
+    run coroutine in the default runner and wait for the result
+    :param coroutine: coroutine object
+    :param timeout: seconds to wait, None is no limit
+    :return: result of coroutine
+    """
+    return get_runner().run(coroutine, timeout)
+
+
+@atexit.register
+def shutdown_all():
+    for runner in list(runners.values()):
+        runner.shutdown()
@@ -0,0 +1,162 @@
+import contextvars
+import math
+import sys
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+# metrics of the running sync, it is copied into tasks created by the sync, so concurrent syncs of different apps
+# are recorded separately and DingRequest needs no reference to them
+current_metrics = contextvars.ContextVar('dingtalk_sync_metrics', default=None)
+
+
+def percentile(values, percent):
+    """
+    nearest-rank percentile
+    :param values: sorted number list
+    :param percent: 0 - 100
+    :return: number, 0 if values is empty
+    """
+    if not values:
+        return 0
+    index = max(math.ceil(percent / 100 * len(values)) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def peak_memory():
+    """
+    peak resident memory of the process, unit is MB
+    :return: float, 0 if it is unknown
+    """
+    if resource is None:
+        return 0
+    # ru_maxrss is KB on linux and bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(max_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 2)
+
+
+class SyncMetrics(object):
+    """
+    metrics of one sync run, api calls are recorded by DingRequest and records by the sync models
+    """
+
+    def __init__(self):
+        # api_calls, api_retries, api_throttles, api_errors, token_fetches, cache_hits, cache_misses,
+        # departments_fetched, users_fetched and <model>_created/updated/skipped/archived
+        self.counters = Counter()
+        # seconds spent in each part, orm is timed by sync models and network is the sum of request time
+        self.timers = Counter()
+        self.latencies = defaultdict(list)
+        self.endpoint_errors = Counter()
+        self.started = time.monotonic()
+        self.duration = 0
+
+    def incr(self, name, value=1):
+        self.counters[name] += value
+
+    def observe(self, endpoint, seconds, error=False):
+        """
+        record one request of endpoint
+        :param endpoint: url path
+        :param seconds: request time
+        :param error: whether the request raised or was throttled
+        :return:
+        """
+        self.latencies[endpoint].append(seconds)
+        self.timers['network'] += seconds
+        self.counters['api_calls'] += 1
+        if error:
+            self.endpoint_errors[endpoint] += 1
+
+    @contextmanager
+    def timer(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.timers[name] += time.monotonic() - started
+
+    @contextmanager
+    def activate(self):
+        """
+        make self the metrics of the running task and the tasks it creates
+        :return:
+        """
+        token = current_metrics.set(self)
+        try:
+            yield self
+        finally:
+            self.duration = time.monotonic() - self.started
+            current_metrics.reset(token)
+
+    def endpoint_stats(self):
+        """
+        latency of each endpoint, unit is ms
+        :return: list of dict, the slowest endpoint in total first
+        """
+        stats = []
+        for endpoint, latencies in self.latencies.items():
+            latencies = sorted(latencies)
+            stats.append({
+                'endpoint': endpoint,
+                'calls': len(latencies),
+                'errors': self.endpoint_errors[endpoint],
+                'p50': round(percentile(latencies, 50) * 1000, 1),
+                'p90': round(percentile(latencies, 90) * 1000, 1),
+                'p99': round(percentile(latencies, 99) * 1000, 1),
+                'max_latency': round(latencies[-1] * 1000, 1),
+                'total': round(sum(latencies), 3)
+            })
+        return sorted(stats, key=lambda s: s['total'], reverse=True)
+
+    def summary(self):
+        """
+        all metrics in a flat dict, times are in seconds
+        :return: dict
+        """
+        return dict(
+            self.counters,
+            duration=round(self.duration or time.monotonic() - self.started, 3),
+            network_time=round(self.timers['network'], 3),
+            orm_time=round(self.timers['orm'], 3),
+            peak_memory=peak_memory(),
+            endpoints=self.endpoint_stats()
+        )
+
+
+def incr(name, value=1):
+    """
+    increase counter of the running sync, nothing is recorded outside a sync
+    :param name: counter name
+    :param value: increment
+    :return:
+    """
+    metrics = current_metrics.get()
+    if metrics is not None:
+        metrics.incr(name, value)
+
+
+def observe(endpoint, seconds, error=False):
+    metrics = current_metrics.get()
+    if metrics is not None:
+        metrics.observe(endpoint, seconds, error)
+
+
+@contextmanager
+def timed(name):
+    """
+    time the block into timer name of the running sync
+    :param name: timer name
+    :return:
+    """
+    metrics = current_metrics.get()
+    if metrics is None:
+        yield
+        return
+    with metrics.timer(name):
+        yield
@@ -0,0 +1,235 @@
+import gzip
+import hashlib
+import json
+import os
+import time
+import zlib
+
+from .cache import MISSING
+
+
+def stable_hash(value):
+    """
+    hash of json value, the same value always has the same hash
+    :param value: json value
+    :return: hex digest
+    """
+    return hashlib.sha1(json.dumps(value, sort_keys=True, separators=(',', ':'), ensure_ascii=False,
+                                   default=str).encode('utf-8')).hexdigest()
+
+
+def subtree_hashes(departments):
+    """
+    hash of each department with all departments and users under it
+    :param departments: dict of dept_id: (parent dept_id, hash of department itself)
+    :return: dict of dept_id: subtree hash
+    """
+    children = {}
+    for dept_id, (parent_id, _) in departments.items():
+        if parent_id in departments:
+            children.setdefault(parent_id, []).append(dept_id)
+
+    hashes = {}
+    for root_id in departments:
+        # post order without recursion, a deep tree does not hit recursion limit
+        stack = [(root_id, False)]
+        while stack:
+            dept_id, expanded = stack.pop()
+            if dept_id in hashes:
+                continue
+            if not expanded:
+                stack.append((dept_id, True))
+                stack.extend((child_id, False) for child_id in children.get(dept_id, []))
+                continue
+            hashes[dept_id] = stable_hash([departments[dept_id][1]] + sorted(
+                hashes[child_id] for child_id in children.get(dept_id, [])))
+    return hashes
+
+
+class OrgSnapshot(object):
+    """
+    organization fetched by a sync, it is written to a gzip json lines file while it is fetched, so a failed run
+    can resume from it, and the snapshot of the last successful run is kept to find unchanged subtrees.
+    lines are {"type": "department", "detail": {...}} and {"type": "users", "dept_id": "1", "users": [...]},
+    users of a department are written after all of them are fetched.
+    identity is the settings the records are applied with, a snapshot of other settings is neither resumed
+    nor compared with
+    """
+
+    partial_name = 'partial.jsonl.gz'
+    last_name = 'last.jsonl.gz'
+    last_identity_name = 'last.json'
+    checkpoint_name = 'checkpoint.json'
+
+    def __init__(self, directory, identity=None):
+        """
+        :param directory: directory of snapshot files of one app
+        :param identity: json value of settings the snapshot is applied with
+        """
+        self.directory = directory
+        self.identity = identity
+        self.partial_path = os.path.join(directory, self.partial_name)
+        self.last_path = os.path.join(directory, self.last_name)
+        self.last_identity_path = os.path.join(directory, self.last_identity_name)
+        self.checkpoint_path = os.path.join(directory, self.checkpoint_name)
+        self.checkpoint = {}
+        # users of each department fetched by the failed run
+        self.resumed_users = {}
+        self._file = None
+
+    def read_checkpoint(self):
+        try:
+            with open(self.checkpoint_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def update_checkpoint(self, **values):
+        """
+        update checkpoint, file is replaced atomically so it is never half written
+        :param values: checkpoint values
+        :return:
+        """
+        self.checkpoint.update(values)
+        tmp_path = f'{self.checkpoint_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.checkpoint, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def start(self, resume_seconds):
+        """
+        start writing snapshot of a run, the failed run started within resume_seconds is resumed
+        :param resume_seconds: max age of the failed run to resume
+        :return: whether the failed run is resumed
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        checkpoint = self.read_checkpoint()
+        resumed = bool(checkpoint) and time.time() - checkpoint.get('started', 0) < resume_seconds and \
+            checkpoint.get('identity') == self.identity and os.path.exists(self.partial_path)
+        if resumed:
+            self.checkpoint = checkpoint
+            for record in self.read(self.partial_path):
+                if record['type'] == 'users':
+                    self.resumed_users[record['dept_id']] = record['users']
+        else:
+            self.checkpoint = {}
+            if os.path.exists(self.partial_path):
+                os.remove(self.partial_path)
+        self.update_checkpoint(started=checkpoint.get('started', time.time()) if resumed else time.time(),
+                               resumed=resumed, identity=self.identity)
+        # a resumed run appends a new gzip member, lines of the failed run are kept
+        self._file = gzip.open(self.partial_path, 'at', encoding='utf-8')
+        return resumed
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, separators=(',', ':'), ensure_ascii=False) + '\n')
+
+    def write_department(self, detail):
+        self._write({'type': 'department', 'detail': detail})
+
+    def write_users(self, dept_id, users):
+        self._write({'type': 'users', 'dept_id': str(dept_id), 'users': users})
+        # users are the expensive part to fetch, so they are flushed to disk at once
+        self._file.flush()
+
+    def close(self):
+        """
+        close the file and keep partial snapshot and checkpoint, so the next run resumes from them
+        :return:
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def finish(self):
+        """
+        the run succeeds, its snapshot becomes the last snapshot and checkpoint is removed
+        :return:
+        """
+        self.close()
+        self.discard_last()
+        os.replace(self.partial_path, self.last_path)
+        with open(self.last_identity_path, 'w') as f:
+            json.dump({'identity': self.identity, 'finished': time.time()}, f)
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+    def discard_last(self):
+        """
+        remove the last snapshot, so the next run applies every record, used when records may differ from it
+        :return:
+        """
+        for path in (self.last_identity_path, self.last_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _read_last_meta(self, key):
+        try:
+            with open(self.last_identity_path) as f:
+                return json.load(f)[key]
+        except (OSError, ValueError, KeyError):
+            return MISSING
+
+    def read_last_identity(self):
+        return self._read_last_meta('identity')
+
+    def read_last_finished(self):
+        """
+        time the last successful run finished, records written after it may differ from the last snapshot
+        :return: timestamp or None
+        """
+        finished = self._read_last_meta('finished')
+        return None if finished is MISSING else finished
+
+    @staticmethod
+    def read(path):
+        """
+        read records of snapshot, a truncated tail written by a killed process is ignored
+        :param path: snapshot file path
+        :return: iterator of record
+        """
+        if not os.path.exists(path):
+            return
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            try:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        return
+            except (EOFError, zlib.error, OSError):
+                return
+
+    @classmethod
+    def department_hashes(cls, path):
+        """
+        hash of each department and its users in snapshot, the last record of a department wins
+        :param path: snapshot file path
+        :return: dict of dept_id: (parent dept_id, hash)
+        """
+        details = {}
+        users = {}
+        for record in cls.read(path):
+            if record['type'] == 'department':
+                details[str(record['detail']['dept_id'])] = record['detail']
+            else:
+                users[record['dept_id']] = stable_hash(sorted(record['users'], key=lambda user: user['userid']))
+        return {dept_id: (str(detail.get('parent_id')), stable_hash([detail, users.get(dept_id)]))
+                for dept_id, detail in details.items()}
+
+    def unchanged_departments(self):
+        """
+        departments whose subtree, including users, is the same as in the last snapshot of the same identity
+        :return: set of dept_id
+        """
+        if self.read_last_identity() != self.identity:
+            return set()
+        last = self.department_hashes(self.last_path)
+        if not last:
+            return set()
+        # end the gzip member, so the partial snapshot can be read completely, later lines go to a new member
+        self._file.close()
+        self._file = gzip.open(self.partial_path, 'at', encoding='utf-8')
+        last_hashes = subtree_hashes(last)
+        current_hashes = subtree_hashes(self.department_hashes(self.partial_path))
+        return {dept_id for dept_id, subtree_hash in current_hashes.items() if last_hashes.get(dept_id) == subtree_hash}
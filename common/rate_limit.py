@@ -0,0 +1,99 @@
+import asyncio
+import random
+import threading
+import time
+
+
+class TokenBucket(object):
+    """
+    token bucket rate limiter, tokens are reserved under a thread lock, so one bucket can be shared by
+    coroutines of different event loops and threads.
+    the rate adapts to the server, it is cut when a request is throttled and recovers slowly on success,
+    so throughput tracks the qps the server allows when it is lower than the configured rate
+    """
+
+    # rate is multiplied by it when a request is throttled
+    decrease_factor = 0.7
+    # part of the configured rate recovered by each successful request
+    recover_ratio = 0.005
+    # throttled requests within the seconds after a cut are answers to requests sent before it, they do not cut again
+    decrease_interval = 1.0
+    # rate never goes lower than it
+    min_rate = 0.5
+
+    def __init__(self, rate, capacity=None):
+        """
+        :param rate: tokens added per second, it is the sustained qps
+        :param capacity: max burst size, default is rate
+        """
+        self.max_rate = self.rate = float(rate)
+        self.max_capacity = self.capacity = float(capacity or rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._decreased = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self):
+        """
+        take a token, the bucket may go negative which means the token is reserved in the future
+        :return: seconds to wait before the reserved token can be used
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens -= 1
+            return 0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def _set_rate(self, rate):
+        self.rate = rate
+        # burst shrinks with rate, a full burst at the configured size would be throttled again
+        self.capacity = max(1.0, self.max_capacity * rate / self.max_rate)
+        self._tokens = min(self._tokens, self.capacity)
+
+    def throttled(self):
+        """
+        the server throttled a request, cut the rate and drop the burst, so the whole group slows down
+        :return:
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now - self._decreased < self.decrease_interval:
+                return
+            self._decreased = now
+            self._set_rate(max(self.min_rate, self.rate * self.decrease_factor))
+            self._tokens = min(self._tokens, 0)
+
+    def succeeded(self):
+        """
+        a request is not throttled, recover the rate towards the configured rate
+        :return:
+        """
+        if self.rate >= self.max_rate:
+            return
+        with self._lock:
+            self._refill(time.monotonic())
+            self._set_rate(min(self.max_rate, self.rate + self.max_rate * self.recover_ratio))
+
+    async def acquire(self):
+        """
+        wait until a token is available
+        :return:
+        """
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def backoff_delay(attempt, base=0.5, max_delay=10):
+    """
+    exponential backoff with full jitter
+    :param attempt: retry times, start from 0
+    :param base: base delay, unit is second
+    :param max_delay: max delay, unit is second
+    :return: seconds to sleep
+    """
+    return random.uniform(0, min(max_delay, base * 2 ** attempt))
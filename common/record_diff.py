@@ -0,0 +1,68 @@
+import json
+
+
+def _normalize(value):
+    return False if value is None or value == '' else value
+
+
+def _x2many_unchanged(current_ids, commands):
+    """
+    check whether x2many commands change nothing, only link (4) and replace (6) commands can be compared
+    :param current_ids: current record ids
+    :param commands: x2many commands
+    :return:
+    """
+    current_ids = set(current_ids)
+    for command in commands:
+        if command[0] == 4:
+            if command[1] not in current_ids:
+                return False
+        elif command[0] == 6:
+            if set(command[2]) != current_ids:
+                return False
+        else:
+            return False
+    return True
+
+
+def diff_vals(record, vals):
+    """
+    keep only the vals which differ from current values of record, used to skip no-op writes in sync
+    :param record: single record
+    :param vals: vals to write
+    :return: changed vals
+    """
+    changed = {}
+    for name, value in vals.items():
+        field = record._fields[name]
+        current = record[name]
+        if field.type == 'many2one':
+            is_same = current.id == (_normalize(value) or False)
+        elif field.type in ('many2many', 'one2many'):
+            is_same = _x2many_unchanged(current.ids, value or [])
+        elif field.type in ('char', 'text', 'html', 'selection'):
+            value = _normalize(value)
+            is_same = _normalize(current) == (str(value) if value is not False else value)
+        elif field.type == 'json':
+            is_same = (current or None) == (value or None)
+        else:
+            is_same = current == value
+        if not is_same:
+            changed[name] = vals[name]
+    return changed
+
+
+def group_writes(write_list):
+    """
+    group records which are written with the same vals, so they are written by one write
+    :param write_list: list of (record, vals)
+    :return: list of (records, vals)
+    """
+    groups = {}
+    for record, vals in write_list:
+        key = json.dumps(vals, sort_keys=True, default=str)
+        if key in groups:
+            groups[key][0] |= record
+        else:
+            groups[key] = [record, vals]
+    return [tuple(group) for group in groups.values()]
@@ -1,9 +1,26 @@
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+import threading
 import time
 
+try:
+    import fcntl
+except ImportError:  # not posix, file lock is not available
+    fcntl = None
+
 token_temp = {}
+token_lock = threading.RLock()
 
 
 class TokenStore(object):
+    """
+    token store in process memory, it is thread safe but every process has its own token.
+    subclass can override _locked, _read, _write and _delete to store token in other places
+    """
+
     def __init__(self, key):
         """
         key is used to distinguish different Store
@@ -11,34 +28,60 @@ class TokenStore(object):
         """
         self.key = key
 
-    def save(self, token, expires_in, create_time=None):
+    def _locked(self):
         """
-        save token
-        :param token: token
-        :param expires_in: how long the token is valid, unit is second
-        :param create_time: if create_time is None, use current time
-        :return:
+        lock used when read and write token
+        :return: context manager
         """
+        return token_lock
+
+    def _read(self):
+        return token_temp.get(self.key)
+
+    def _write(self, token_dict):
+        token_temp[self.key] = token_dict
+
+    def _delete(self):
+        token_temp.pop(self.key, None)
+
+    @staticmethod
+    def _token_dict(token, expires_in, create_time=None):
         current_time = time.time()
-        token_temp[self.key] = {
+        return {
             'token': token,
             'expires_in': expires_in,
             'update_time': current_time,
             'create_time': create_time or current_time
         }
 
-    def get(self):
+    def save(self, token, expires_in, create_time=None):
+        """
+        save token
+        :param token: token
+        :param expires_in: how long the token is valid, unit is second
+        :param create_time: if create_time is None, use current time
+        :return:
+        """
+        with self._locked():
+            self._write(self._token_dict(token, expires_in, create_time))
+
+    def get(self, margin=0):
         """
         if token is expires, clear it and return None
+        :param margin: treat the token as expired when it is valid for less than margin seconds
         :return:
         """
-        if self.key in token_temp:
-            token = token_temp[self.key]
-            if time.time() - token['update_time'] > token['expires_in']:
-                token_temp.pop(self.key)
+        with self._locked():
+            token = self._read()
+            if token is None:
+                return None
+            elapsed = time.time() - token['update_time']
+            if elapsed > token['expires_in']:
+                self._delete()
+                return None
+            if elapsed > token['expires_in'] - margin:
                 return None
             return token['token']
-        return None
 
     def refresh(self, expires_in):
         """
@@ -46,25 +89,160 @@ class TokenStore(object):
         :param expires_in: how long the token is valid, unit is second
         :return:
         """
-        if self.key in token_temp:
-            token_dict = token_temp[self.key]
-            self.save(token_dict['token'], expires_in, token_dict['create_time'])
+        with self._locked():
+            token_dict = self._read()
+            if token_dict is not None:
+                self._write(self._token_dict(token_dict['token'], expires_in, token_dict['create_time']))
 
-    @staticmethod
-    def clean(key):
+    @classmethod
+    def clean(cls, key):
         """
         clean token by key
         :param key: string
         :return:
         """
-        if key in token_temp:
-            token_temp.pop(key)
+        store = cls(key)
+        with store._locked():
+            store._delete()
 
-    @staticmethod
-    def clean_all():
+    @classmethod
+    def clean_all(cls):
         """
         clean all token
-        :return: 
+        :return:
+        """
+        with token_lock:
+            token_temp.clear()
+
+
+def default_token_directory():
+    """
+    directory of token files, it is under odoo data_dir, which is private to the odoo user,
+    a private directory of the current user in system temp dir is used without odoo
+    :return: directory path
+    """
+    try:
+        from odoo.tools import config
+        return os.path.join(config['data_dir'], 'dingtalk_token')
+    except ImportError:
+        uid = os.getuid() if hasattr(os, 'getuid') else 0
+        return os.path.join(tempfile.gettempdir(), f'odoo_dingtalk_token_{uid}')
+
+
+def ensure_private_directory(directory):
+    """
+    create directory which only the current user can access, an existing directory of other users is refused,
+    so tokens are never written to or read from a directory which others control
+    :param directory: directory path
+    :return:
+    """
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    if not hasattr(os, 'getuid'):
+        return
+    stat = os.lstat(directory)
+    if not os.path.isdir(directory) or os.path.islink(directory) or stat.st_uid != os.getuid():
+        raise PermissionError(f'token directory {directory} is not a directory owned by the current user')
+    if stat.st_mode & 0o077:
+        os.chmod(directory, 0o700)
+
+
+class FileTokenStore(TokenStore):
+    """
+    token store in local files, every worker process on the same node shares one token per key.
+    file is locked by flock when read and write, and replaced atomically when write.
+    the token is kept in memory, and the file is read again only when the token is near expiry or the file is
+    changed by another process, so most api requests do not touch the file
+    """
+    # None is default_token_directory()
+    directory = None
+    # seconds between two checks whether the token file is changed by another process
+    check_interval = 10
+
+    def __init__(self, key):
+        super().__init__(key)
+        self.directory = self.get_directory()
+        ensure_private_directory(self.directory)
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        self.path = os.path.join(self.directory, f'{name}.json')
+        self.lock_path = os.path.join(self.directory, f'{name}.lock')
+        # (token dict, mtime of token file) of the last read or write
+        self._cached = None
+        self._checked = 0
+
+    @classmethod
+    def get_directory(cls):
+        return cls.directory or default_token_directory()
+
+    def _file_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _remember(self, token_dict):
+        self._cached = (token_dict, self._file_mtime()) if token_dict is not None else None
+        self._checked = time.time()
+
+    def get(self, margin=0):
+        cached = self._cached
+        if cached is not None:
+            token_dict, mtime = cached
+            now = time.time()
+            if now - token_dict['update_time'] <= token_dict['expires_in'] - margin:
+                if now - self._checked < self.check_interval:
+                    return token_dict['token']
+                if self._file_mtime() == mtime:
+                    self._checked = now
+                    return token_dict['token']
+        return super().get(margin)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # flock is held per open file description, the thread lock protects threads of the same process
+        with token_lock, open(self.lock_path, 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                token_dict = json.load(f)
+        except (OSError, ValueError):
+            token_dict = None
+        self._remember(token_dict)
+        return token_dict
+
+    def _write(self, token_dict):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(token_dict, f)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            raise
+        self._remember(token_dict)
+
+    def _delete(self):
+        self._remember(None)
+        with contextlib.suppress(OSError):
+            os.remove(self.path)
+
+    @classmethod
+    def clean_all(cls):
+        """
+        clean all token files, tokens kept in memory of other stores are dropped when they see the file removed
+        :return:
         """
-        for key in token_temp:
-            token_temp.pop(key)
+        directory = cls.get_directory()
+        with token_lock:
+            for filename in os.listdir(directory) if os.path.isdir(directory) else []:
+                if filename.endswith('.json'):
+                    with contextlib.suppress(OSError):
+                        os.remove(os.path.join(directory, filename))
@@ -0,0 +1,85 @@
+import asyncio
+import concurrent.futures
+import os
+import threading
+
+
+class SyncScheduler(object):
+    """
+    run sync jobs in a pool of worker threads, each thread runs its job in its own event loop, so the blocking ORM
+    work of a job never stalls jobs of other keys, nor logins and messages which run in the default runner.
+    a job of a key is merged into the job of the same key which is queued or running, so jobs of a key never
+    overlap, and jobs of different keys run in parallel up to max_workers
+    """
+
+    max_workers = 4
+
+    def __init__(self, max_workers=None):
+        """
+        :param max_workers: max jobs running at the same time
+        """
+        self.max_workers = max_workers or self.max_workers
+        self._executor = concurrent.futures.ThreadPoolExecutor(self.max_workers, thread_name_prefix='dingtalk-sync')
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # key: future of the queued or running job
+        self._jobs = {}
+
+    def _get_loop(self):
+        """
+        get the event loop of the current worker thread, it is reused by the jobs of the thread
+        :return: asyncio event loop
+        """
+        loop = getattr(self._local, 'loop', None)
+        if loop is None or loop.is_closed():
+            loop = self._local.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+        return loop
+
+    def schedule(self, key, coroutine_func):
+        """
+        schedule job of key, it is merged into the queued or running job of the same key if there is one
+        :param key: hashable job key, such as database and app id
+        :param coroutine_func: function returns the coroutine of the job
+        :return: (concurrent.futures.Future of the job, whether it is merged into an existing job)
+        """
+        with self._lock:
+            future = self._jobs.get(key)
+            if future is not None:
+                return future, True
+            future = self._jobs[key] = self._executor.submit(self._run, key, coroutine_func)
+        return future, False
+
+    def is_scheduled(self, key):
+        with self._lock:
+            return key in self._jobs
+
+    def _run(self, key, coroutine_func):
+        from .ding_request import close_all_sessions
+
+        loop = self._get_loop()
+        try:
+            return loop.run_until_complete(coroutine_func())
+        finally:
+            # sessions are bound to the loop of this thread, they are not kept between jobs
+            loop.run_until_complete(close_all_sessions())
+            with self._lock:
+                self._jobs.pop(key, None)
+
+
+scheduler = None
+scheduler_pid = None
+scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """
+    get the scheduler shared in the process, a forked worker process creates its own
+    :return: SyncScheduler
+    """
+    global scheduler, scheduler_pid
+    with scheduler_lock:
+        if scheduler is None or scheduler_pid != os.getpid():
+            scheduler = SyncScheduler()
+            scheduler_pid = os.getpid()
+        return scheduler
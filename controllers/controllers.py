@@ -1,19 +1,19 @@
 # -*- coding: utf-8 -*-
 import json
-import asyncio
-import re
 from urllib import parse
 
 from odoo import http
 from odoo.http import request, route
 
-from ..common.ding_request import join_url, ding_request_instance
+from ..common.ding_request import join_url
 from ..common.DingCallbackCrypto import DingCallbackCrypto3
 
 
 class DingTalkController(http.Controller):
     scan_oauth_url = 'https://open.work.weixin.qq.com/wwopen/sso/qrConnect?appid={corp_id}&agentid={agentid}&redirect_uri={redirect_uri}'
     web_oauth_url = 'https://login.dingtalk.com/oauth2/auth?redirect_uri={redirect_uri}&response_type=code&client_id={client_id}&scope={scope}&prompt=consent'
+    # seconds to wait for Dingtalk when login by oauth2
+    oauth_timeout = 30
 
     @classmethod
     def force_authenticate(cls, session, user):
@@ -39,11 +39,6 @@ class DingTalkController(http.Controller):
             join_url(host, redirect_uri)
         }
 
-    async def test_api(self, ding_request):
-        with open('/Users/admin/workspace/python_project/odoo-16/test_addons/dingtalk/static/all_users.png', 'rb') as f:
-            content = f.read()
-            print(ding_request.upload_media('image', content, 'all_users.png'))
-
     @route('/ding/oauth2/login/<int:app_id>', type='http', auth='public')
     def login_by_oauth2(self, authCode, app_id):
         """
@@ -53,21 +48,14 @@ class DingTalkController(http.Controller):
         :return:
         """
         app = request.env['dingtalk.app'].sudo().browse(int(app_id))
-        ding_request = ding_request_instance(app.app_key, app.app_secret)
 
-        async def _get_user_info():
+        async def _get_user_info(ding_request):
             access_token = (await ding_request.get_user_access_token(app.app_key, app.app_secret, authCode))[
                 'accessToken']
             return await ding_request.get_user_info_by_access_token(access_token)
 
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        get_user_info = loop.create_task(_get_user_info())
-        loop.run_until_complete(get_user_info)
-        loop.close()
-
-        user_info = get_user_info.result()
-        employee = request.env['hr.employee'].sudo().search([('ding_id', '=', user_info['unionId'])])
+        user_info = app.ding_run(_get_user_info, self.oauth_timeout)
+        employee = request.env['hr.employee'].sudo().ding_resolve(unionids=[user_info['unionId']]).filtered('active')[:1]
         if employee.user_id.id:
             self.force_authenticate(request.session, employee.user_id)
             return request.redirect('/web')
@@ -109,18 +97,9 @@ class DingTalkController(http.Controller):
             signature, timestamp, nonce, data['encrypt']
         ))
 
-        event_type = content['EventType']
-        if event_type != 'check_url':
-            model = None
-            if re.match(r'^user_.*?_org$', event_type) is not None:
-                model = request.env['hr.employee']
-            elif re.match(r'^org_dept_.*?$', event_type) is not None:
-                model = request.env['hr.department']
-
-            if model is not None:
-                func = getattr(model, f'on_ding_{event_type}', None)
-                if func:
-                    func(content, app)
+        # save the event and return at once, events are applied by cron in batches
+        if content['EventType'] != 'check_url':
+            request.env['dingtalk.callback.event'].sudo().enqueue(app, content)
         return json.dumps(ding_callback_crypto.getEncryptedMap('success'))
 
 
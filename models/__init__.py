@@ -6,5 +6,6 @@ from . import department
 from . import employee
 from . import log
 from . import res_users
-
-
+from . import callback_event
+from . import message
+from . import media
@@ -1,13 +1,21 @@
 import asyncio
+import concurrent.futures
 import datetime
-import threading
-import time
+import logging
+import os
 import traceback
 
 from odoo import models, fields, api
+from odoo.tools import config
 from odoo.tools.translate import _
 
 from ..common.ding_request import ding_request_instance
+from ..common.loop_runner import run_coroutine
+from ..common.metrics import SyncMetrics
+from ..common.org_snapshot import OrgSnapshot
+from ..common.sync_scheduler import get_scheduler
+
+_logger = logging.getLogger(__name__)
 
 
 def get_now_time_str():
@@ -29,55 +37,211 @@ class App(models.Model):
     # callback settings
     token = fields.Char(string='Token')
     encoding_aes_key = fields.Char(string='EncodingAESKey')
+    auto_sync = fields.Boolean(string='Sync by Cron', default=False)
 
-    def run_ding_sync(self):
-        self.env['bus.bus']._sendone(self.env.user.partner_id, 'simple_notification', {
-            'title': 'Sync Start......',
-            'message': _('Start sync organization now, please wait......'),
-            'warning': True
+    # seconds between two progress notifications of sync
+    sync_progress_interval = 3
+    # a failed sync started within the seconds is resumed from its snapshot
+    sync_resume_seconds = 12 * 3600
+    # records are applied differently when these fields change, so the snapshot of other values is not reused
+    sync_identity_fields = ('app_key', 'company_id', 'sync_with_user')
+
+    def write(self, vals):
+        res = super().write(vals)
+        if set(self.sync_identity_fields) & vals.keys():
+            for app in self:
+                app._ding_snapshot().discard_last()
+        return res
+
+    def _ding_snapshot(self):
+        """
+        snapshot of organization sync of this app in filestore
+        :return: OrgSnapshot
+        """
+        self.ensure_one()
+        return OrgSnapshot(os.path.join(config.filestore(self.env.cr.dbname), 'dingtalk_sync', str(self.id)), {
+            name: self[name].id if self._fields[name].type == 'many2one' else self[name]
+            for name in self.sync_identity_fields
         })
 
-        # create a threading to avoid odoo ui blocking
-        def _sync():
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            asyncio.run(self.sync_ding_organization())
+    def get_ding_request(self):
+        """
+        get DingRequest of this app, it is shared in the process
+        :return: DingRequest
+        """
+        self.ensure_one()
+        return ding_request_instance(self.app_key, self.app_secret, self.env.cr.dbname)
+
+    def ding_run(self, coroutine_func, timeout=None):
+        """
+        run coroutine with DingRequest of this app in the shared event loop and wait for the result
+        :param coroutine_func: function which receives DingRequest and returns a coroutine
+        :param timeout: seconds to wait, None is no limit
+        :return: result of coroutine
+        """
+        return run_coroutine(coroutine_func(self.get_ding_request()), timeout)
+
+    def ding_upload_media(self, media_type, path=None, attachment=None, filename=None):
+        """
+        upload media from file path or ir.attachment, media_id of the same content is reused until it expires
+        :param media_type: image, voice, video or file
+        :param path: file path
+        :param attachment: ir.attachment record
+        :param filename: media filename
+        :return: media_id
+        """
+        self.ensure_one()
+        return self.env['dingtalk.media'].sudo().upload(self, media_type, path, attachment, filename)
+
+    def _ding_try_lock(self):
+        """
+        take the session advisory lock of the app, it serializes writes of sync and callback events of the app
+        between workers, it stays held on the pooled connection until _ding_unlock
+        :return: whether the lock is taken
+        """
+        self.ensure_one()
+        self.env.cr.execute('SELECT pg_try_advisory_lock(hashtext(%s), %s)', (self._name, self.id))
+        return self.env.cr.fetchone()[0]
+
+    def _ding_unlock(self):
+        self.ensure_one()
+        self.env.cr.execute('SELECT pg_advisory_unlock(hashtext(%s), %s)', (self._name, self.id))
+
+    def _ding_sync_key(self):
+        return self.env.cr.dbname, self.id
+
+    def schedule_ding_sync(self):
+        """
+        schedule organization sync of apps, a request is merged into the sync of the same app which is queued or
+        running, and syncs of different apps run in parallel
+        :return: dict of app id: (concurrent.futures.Future, whether it is merged into a queued or running sync)
+        """
+        return {app.id: get_scheduler().schedule(app._ding_sync_key(), app.sync_ding_organization)
+                for app in self}
+
+    def run_ding_sync(self):
+        for app, (future, merged) in zip(self, self.schedule_ding_sync().values()):
+            self.env['bus.bus']._sendone(self.env.user.partner_id, 'simple_notification', {
+                'title': 'Sync Start......',
+                'message': _('Sync of %s is already queued or running.', app.name)
+                if merged else _('Start sync organization now, please wait......'),
+                'warning': True
+            })
+
+    @api.model
+    def cron_sync_organizations(self):
+        """
+        sync organization of apps with auto sync, cron waits until all syncs end
+        :return:
+        """
+        futures = self.search([('auto_sync', '=', True)]).schedule_ding_sync()
+        concurrent.futures.wait([future for future, merged in futures.values()])
 
-        thread = threading.Thread(target=_sync)
-        thread.start()
+    async def _report_ding_sync_progress(self, sync_metrics, partner_id, interval):
+        """
+        send sync progress through bus at most once every interval seconds, only when it changes
+        :param sync_metrics: SyncMetrics of the running sync
+        :param partner_id: res.partner id notified
+        :param interval: seconds between two notifications
+        :return:
+        """
+        last_progress = None
+        while True:
+            await asyncio.sleep(interval)
+            counters = sync_metrics.counters
+            progress = {
+                'app_id': self.id,
+                'app_name': self.name,
+                'departments_done': sum(counters[f'department_{state}'] for state in ('created', 'updated', 'skipped')),
+                'departments_total': counters['departments_fetched'],
+                'users_done': sum(counters[f'employee_{state}'] for state in ('created', 'updated', 'skipped')),
+                'users_total': counters['users_collected'],
+                'done': False
+            }
+            if progress != last_progress:
+                self._send_ding_sync_progress(partner_id, progress)
+                last_progress = progress
+
+    def _send_ding_sync_progress(self, partner_id, progress):
+        # the sync cursor is committed only at the end, so progress is sent by its own cursor
+        with self.env.registry.cursor() as cr:
+            env = api.Environment(cr, self.env.uid, {})
+            env['bus.bus']._sendone(env['res.partner'].browse(partner_id), 'dingtalk_sync_progress', progress)
 
     async def sync_ding_organization(self):
-        start = time.time()
+        start_time = fields.Datetime.now()
         uid = self.env.uid
         is_success = True
         with self.env.registry.cursor() as new_cr:
             self.env = api.Environment(new_cr, uid, self.env.context)
 
-            detail_log = f'start sync at {get_now_time_str()}......'
-            try:
-                ding_request = ding_request_instance(self.app_key, self.app_secret)
-
-                # get dingtalk auth scope
-                auth_scopes = await ding_request.get_auth_scopes()
-
-                await self.env['hr.department'].with_context(
-                    self.env.context, ding_app=self, ding_request=ding_request,
-                    auth_scopes=auth_scopes
-                ).sync_ding_department()
-                detail_log += f'\nsync success!'
-            except Exception:
-                is_success = False
-                detail_log += f'\nsync failed, error: \n{traceback.format_exc()}'
-            finally:
-                detail_log += f'\nsync end at {get_now_time_str()}, cost {round(time.time() - start, 2)}s'
-                company_id = self.company_id.id
+            # the scheduler serializes syncs of an app in this process, the lock serializes them between workers
+            if not self._ding_try_lock():
+                _logger.info('Dingtalk sync of app %s is running in another worker, skipped', self.name)
                 self.env['dingtalk.log'].create({
-                    'company_id': company_id,
+                    'company_id': self.company_id.id,
                     'ding_app_id': self.id,
-                    'detail': detail_log
+                    'state': 'skipped',
+                    'start_time': start_time,
+                    'end_time': fields.Datetime.now(),
+                    'detail': 'sync is running in another worker, skipped'
+                })
+                self.env['bus.bus']._sendone(self.env.user.partner_id, 'simple_notification', {
+                    'title': 'Sync End......',
+                    'message': _('Sync of %s is running in another worker, skipped.', self.name),
+                    'warning': True
                 })
+                return
+
+            # a session lock stays held on the pooled connection after the cursor is closed, so finally must
+            # release it whatever happens
+            snapshot = None
+            try:
+                detail_log = f'start sync at {get_now_time_str()}......'
+                ding_request = self.get_ding_request()
+                snapshot = self._ding_snapshot()
+                if snapshot.start(self.sync_resume_seconds):
+                    detail_log += f'\nresume the failed sync, fetched users of {len(snapshot.resumed_users)} ' \
+                                  f'departments are reused'
+                partner_id = self.env.user.partner_id.id
+                sync_metrics = SyncMetrics()
+                with sync_metrics.activate():
+                    progress_task = asyncio.ensure_future(
+                        self._report_ding_sync_progress(sync_metrics, partner_id, self.sync_progress_interval))
+                    try:
+
+                        # get dingtalk auth scope
+                        auth_scopes = await ding_request.get_auth_scopes()
+
+                        await self.env['hr.department'].with_context(
+                            self.env.context, ding_app=self, ding_request=ding_request,
+                            auth_scopes=auth_scopes, ding_sync_stats=sync_metrics.counters, ding_snapshot=snapshot
+                        ).sync_ding_department()
+                        new_cr.commit()
+                        snapshot.finish()
+                        detail_log += f'\nsync success!'
+                    except Exception:
+                        is_success = False
+                        detail_log += f'\nsync failed, error: \n{traceback.format_exc()}'
+                        # committed batches are kept, the next run resumes from them
+                        new_cr.rollback()
+                    finally:
+                        progress_task.cancel()
+                detail_log += f'\nsync end at {get_now_time_str()}, cost {round(sync_metrics.duration, 2)}s'
+                _logger.info('Dingtalk sync of app %s %s: %s', self.name, 'success' if is_success else 'failed',
+                             {key: value for key, value in sync_metrics.summary().items() if key != 'endpoints'})
+                self.env['dingtalk.log'].create_from_metrics(
+                    self, sync_metrics, 'success' if is_success else 'failed', start_time, detail_log)
+                self._send_ding_sync_progress(partner_id, {'app_id': self.id, 'done': True})
                 self.env['bus.bus']._sendone(self.env.user.partner_id, 'simple_notification', {
                     'title': 'Sync End......',
                     'message': f'Sync organization end, {"success" if is_success else "failed"}',
                     'warning': True if is_success else False
-                })
\ No newline at end of file
+                })
+            except BaseException:
+                new_cr.rollback()
+                raise
+            finally:
+                if snapshot is not None:
+                    snapshot.close()
+                self._ding_unlock()
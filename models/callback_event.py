@@ -0,0 +1,192 @@
+import datetime
+import logging
+import re
+import traceback
+
+from odoo import models, fields, api
+
+_logger = logging.getLogger(__name__)
+
+
+class CallbackEvent(models.Model):
+    """
+    Dingtalk callback event queue, callback request only saves the event and returns at once,
+    events are applied in batches by cron
+    """
+    _name = 'dingtalk.callback.event'
+    _description = 'Dingtalk Callback Event'
+    _order = 'id desc'
+
+    ding_app_id = fields.Many2one('dingtalk.app', string='Dingtalk App', required=True, ondelete='cascade')
+    event_type = fields.Char(string='Event Type', required=True, index=True)
+    content = fields.Json(string='Content')
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('failed', 'Failed')
+    ], string='State', default='pending', required=True, index=True)
+    error = fields.Text(string='Error')
+    attempts = fields.Integer(string='Attempts', default=0)
+    next_attempt = fields.Datetime(string='Next Attempt', index=True,
+                                   help='A failed event is retried after this time')
+
+    # events of the same object are merged, only the last event of an id decides what to do
+    coalesce_keys = {
+        'hr.employee': 'UserId',
+        'hr.department': 'DeptId'
+    }
+    # calls of models are applied in this order, users refer to departments
+    model_order = ['hr.department', 'hr.employee']
+    # days to keep done events
+    keep_days = 7
+    # a failed event is retried until it fails max_attempts times
+    max_attempts = 5
+    # seconds before the first retry, doubled for each later retry
+    retry_delay = 60
+
+    @api.model
+    def get_event_model(self, event_type):
+        """
+        get model name which handles the event
+        :param event_type: Dingtalk EventType
+        :return: model name or None
+        """
+        if re.match(r'^user_.*?_org$', event_type) is not None:
+            return 'hr.employee'
+        elif re.match(r'^org_dept_.*?$', event_type) is not None:
+            return 'hr.department'
+        return None
+
+    @api.model
+    def enqueue(self, app, content):
+        """
+        save event which has a handler, it will be applied by cron
+        :param app: dingtalk.app record
+        :param content: decrypted callback content
+        :return: dingtalk.callback.event record
+        """
+        event_type = content['EventType']
+        model_name = self.get_event_model(event_type)
+        if model_name is None or not hasattr(self.env[model_name], f'on_ding_{event_type}'):
+            return self.browse()
+        return self.create({
+            'ding_app_id': app.id,
+            'event_type': event_type,
+            'content': content
+        })
+
+    def _coalesce(self):
+        """
+        merge events, for each id only its last event is kept, then ids with the same last event type are
+        handled by one call, department calls are before employee calls
+        :return: list of (model name, event type, content, events merged into the call)
+        """
+        calls = []
+        last_events = {}
+        object_events = {}
+        for event in self.sorted('id'):
+            model_name = self.get_event_model(event.event_type)
+            id_key = self.coalesce_keys.get(model_name)
+            if id_key is None or id_key not in (event.content or {}):
+                calls.append((model_name, event.event_type, event.content, event))
+                continue
+            for object_id in event.content[id_key]:
+                last_events[(model_name, object_id)] = event.event_type
+                object_events[(model_name, object_id)] = object_events.get((model_name, object_id),
+                                                                           self.browse()) | event
+
+        merged = {}
+        for (model_name, object_id), event_type in last_events.items():
+            group = merged.setdefault((model_name, event_type), [[], self.browse()])
+            group[0].append(object_id)
+            group[1] |= object_events[(model_name, object_id)]
+        for (model_name, event_type), (object_ids, events) in merged.items():
+            calls.append((model_name, event_type, {
+                'EventType': event_type,
+                self.coalesce_keys[model_name]: object_ids
+            }, events))
+        # sorted is stable, calls of a model keep their order
+        return sorted(calls, key=lambda call: self.model_order.index(call[0]) if call[0] in self.model_order
+                      else len(self.model_order))
+
+    def _retry_later(self, error):
+        """
+        count a failed attempt, events are retried later with backoff until max_attempts
+        :param error: error text
+        :return:
+        """
+        now = fields.Datetime.now()
+        # records of the apps may differ from Dingtalk now, so the next full sync applies every record
+        for app in self.ding_app_id:
+            app._ding_snapshot().discard_last()
+        for event in self:
+            attempts = event.attempts + 1
+            if attempts >= self.max_attempts:
+                event.write({'state': 'failed', 'attempts': attempts, 'error': error, 'next_attempt': False})
+            else:
+                event.write({
+                    'attempts': attempts,
+                    'error': error,
+                    'next_attempt': now + datetime.timedelta(seconds=self.retry_delay * 2 ** (attempts - 1))
+                })
+
+    def action_retry(self):
+        """
+        requeue failed events, they are applied by the next cron run
+        :return:
+        """
+        self.filtered(lambda e: e.state == 'failed').write({'state': 'pending', 'attempts': 0, 'next_attempt': False})
+
+    @api.model
+    def process_events(self, limit=1000):
+        """
+        apply pending events in batches, events of each app are coalesced before applied
+        :param limit: max events in one batch
+        :return:
+        """
+        # apps whose sync is running, their events stay pending until the sync ends
+        busy_app_ids = []
+        while True:
+            # events which failed are retried after their next_attempt, later events are not blocked by them
+            events = self.search([
+                ('state', '=', 'pending'),
+                ('ding_app_id', 'not in', busy_app_ids),
+                '|', ('next_attempt', '=', False), ('next_attempt', '<=', fields.Datetime.now())
+            ], order='id', limit=limit)
+            if not events:
+                break
+            for app in events.ding_app_id:
+                # the same lock as sync, both write the same employees
+                if not app._ding_try_lock():
+                    busy_app_ids.append(app.id)
+                    continue
+                try:
+                    app_events = events.filtered(lambda e: e.ding_app_id == app)
+                    failed = self.browse()
+                    for model_name, event_type, content, call_events in app_events._coalesce():
+                        try:
+                            with self.env.cr.savepoint():
+                                getattr(self.env[model_name], f'on_ding_{event_type}')(content, app)
+                        except Exception:
+                            _logger.exception('apply Dingtalk event %s failed', event_type)
+                            # an event merged into many calls fails if any of them fails
+                            (call_events - failed)._retry_later(traceback.format_exc())
+                            failed |= call_events
+                    (app_events - failed).write({'state': 'done', 'error': False, 'next_attempt': False})
+                finally:
+                    app._ding_unlock()
+            # commit every batch, so applied events are not applied again when a later batch fails
+            self.env.cr.commit()
+            if len(events) < limit:
+                break
+
+    @api.autovacuum
+    def _gc_done_events(self):
+        """
+        remove done events older than keep_days
+        :return:
+        """
+        self.search([
+            ('state', '=', 'done'),
+            ('create_date', '<', fields.Datetime.now() - datetime.timedelta(days=self.keep_days))
+        ]).unlink()
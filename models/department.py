@@ -1,12 +1,18 @@
 import asyncio
+import datetime
+from collections import Counter
 
-from odoo import models, fields
+from odoo import models, fields, api
+
+from ..common.ding_request import is_not_found
+from ..common.metrics import timed
+from ..common.record_diff import diff_vals, group_writes
 
 
 class Department(models.Model):
     _inherit = 'hr.department'
 
-    ding_id = fields.Char(string='Dingtalk Department ID')
+    ding_id = fields.Char(string='Dingtalk Department ID', index=True)
     ding_parent_id = fields.Char(string='Dingtalk Parent Department ID')
     ding_order = fields.Integer(string='Dingtalk Department Order')
     '''because a Dingtalk user can have multi departments, so we need a many2many field, 
@@ -14,33 +20,129 @@ class Department(models.Model):
     ding_employee_ids = fields.Many2many('hr.employee', 'ding_employee_department_rel', 'department_id', 'employee_id',
                                          string='Dingtalk Employees')
 
-    async def get_ding_server_depart_tree(self, dep_ids, for_in_callback=None):
+    # departments upserted in one batch when sync
+    ding_upsert_batch_size = 200
+    # skip members whose departments are all in subtrees unchanged since the last successful sync
+    ding_skip_unchanged = True
+    # fields not in department_listsub which are fetched by department_detail of every department when sync.
+    # without order, ding_order is the position of a department in the listing of its parent, which keeps
+    # Dingtalk order but not its values, add 'order' to sync the values at one more api call of each department
+    ding_detail_fields = ()
+
+    _sql_constraints = [
+        ('ding_id_company_uniq', 'unique(ding_id, company_id)', 'Dingtalk department ID must be unique per company!')
+    ]
+
+    @api.model
+    def ding_resolve_ids(self, dept_ids, company_id=None):
         """
-        get Dingtalk server department id tree
-        :param dep_ids: server department id list
-        :param for_in_callback: callback function in for loop
-        :return:
+        resolve Dingtalk department ids to department ids with one indexed query, archived departments are included
+        :param dept_ids: Dingtalk department id list, int or str
+        :param company_id: company id, None is all companies
+        :return: dict of str Dingtalk department id: department id, ids not found are not included
         """
-        ding_request = self.env.context.get('ding_request')
-        tree = []
+        dept_ids = list({str(dept_id) for dept_id in dept_ids if dept_id})
+        if not dept_ids:
+            return {}
+        domain = [('ding_id', 'in', dept_ids)]
+        if company_id:
+            domain.append(('company_id', '=', company_id))
+        id_map = {}
+        for department in self.with_context(active_test=False).search_read(domain, ['ding_id'], order='id'):
+            id_map.setdefault(department['ding_id'], department['id'])
+        return id_map
 
-        _tasks = []
+    @api.model
+    def ding_resolve(self, dept_ids, company_id=None):
+        """
+        resolve Dingtalk department ids to departments
+        :param dept_ids: Dingtalk department id list
+        :param company_id: company id, None is all companies
+        :return: hr.department recordset, archived departments are included
+        """
+        return self.browse(list(dict.fromkeys(self.ding_resolve_ids(dept_ids, company_id).values())))
 
-        async def _append_to_tree(parent_dep_id, _tree):
-            sublist = await ding_request.department_listsubid(parent_dep_id)
-            _tree.append({
-                'id': parent_dep_id,
-                'children': await self.get_ding_server_depart_tree(sublist, for_in_callback)
-            })
+    def _ding_department_vals(self, dep_detail, parent_id):
+        """
+        vals of department from Dingtalk department detail
+        :param dep_detail: department detail from Dingtalk
+        :param parent_id: hr.department id of parent
+        :return: dict
+        """
+        vals = {
+            'company_id': self.env.context.get('ding_app').company_id.id,
+            'name': dep_detail['name'],
+            'ding_id': str(dep_detail['dept_id']),
+            'ding_parent_id': dep_detail.get('parent_id', None),  # root department has no parent_id
+            'parent_id': parent_id,
+            'active': True
+        }
+        # department listed by department_listsub has no order, its position in the listing keeps the order
+        if 'order' in dep_detail:
+            vals['ding_order'] = dep_detail['order']
+        elif 'position' in dep_detail:
+            vals['ding_order'] = dep_detail['position']
+        return vals
 
-        for dep_id in dep_ids:
-            if for_in_callback:
-                for_in_callback(dep_id)
-            _tasks.append(_append_to_tree(dep_id, tree))
+    def upsert_ding_department(self, dep_detail, parent_id):
+        """
+        create or write department by Dingtalk department detail, only changed fields are written
+        :param dep_detail: department detail from Dingtalk
+        :param parent_id: hr.department id of parent
+        :return: hr.department record
+        """
+        dep_ids = {str(dep_detail['parent_id']): parent_id} if dep_detail.get('parent_id') else {}
+        self.upsert_ding_departments([dep_detail], dep_ids)
+        return self.browse(dep_ids[str(dep_detail['dept_id'])])
 
-        await asyncio.gather(*_tasks)
+    def upsert_ding_departments(self, dep_details, dep_ids):
+        """
+        create or write departments level by level, parents are applied before their children, departments of
+        a level are created by one create and written by grouped writes, only changed fields are written.
+        hierarchy fields such as complete_name are recomputed when the model is flushed, not for each department
+        :param dep_details: department details from Dingtalk, in any order
+        :param dep_ids: dict of str Dingtalk department id: hr.department id, parents not in dep_details are looked
+            up in it, and the applied departments are added to it
+        :return:
+        """
+        ding_app = self.env.context.get('ding_app')
+        sync_stats = self.env.context.get('ding_sync_stats', Counter())
+        departments = self.with_context(active_test=False)
 
-        return tree
+        existing_ids = departments.ding_resolve_ids([detail['dept_id'] for detail in dep_details],
+                                                    ding_app.company_id.id)
+        # iterate the recordset, so fields of all existing departments are read by one query
+        existing = {dep.ding_id: dep for dep in departments.browse(list(existing_ids.values()))}
+        pending = {str(detail['dept_id']): detail for detail in dep_details}
+        while pending:
+            # a department whose parent is also pending waits for the parent to be applied
+            level = [detail for detail in pending.values() if str(detail.get('parent_id')) not in pending] or \
+                list(pending.values())
+            create_list = []
+            write_list = []
+            for detail in level:
+                ding_id = str(detail['dept_id'])
+                pending.pop(ding_id)
+                vals = self._ding_department_vals(detail, dep_ids.get(str(detail.get('parent_id')), False))
+                dep = existing.get(ding_id)
+                if dep is None:
+                    create_list.append(vals)
+                    continue
+                dep_ids[ding_id] = dep.id
+                # manager is written by set_ding_managers only when it changes
+                changed_data = diff_vals(dep, vals)
+                if changed_data:
+                    write_list.append((dep, changed_data))
+                    sync_stats['department_updated'] += 1
+                else:
+                    sync_stats['department_skipped'] += 1
+
+            for records, vals in group_writes(write_list):
+                records.write(vals)
+            if create_list:
+                for dep, vals in zip(self.create(create_list), create_list):
+                    dep_ids[vals['ding_id']] = dep.id
+                sync_stats['department_created'] += len(create_list)
 
     async def sync_ding_department(self):
         """
@@ -48,59 +150,242 @@ class Department(models.Model):
         :return:
         """
         ding_request = self.env.context.get('ding_request')
-        ding_app = self.env.context.get('ding_app')
         auth_scopes = self.env.context.get('auth_scopes')
+        sync_stats = self.env.context.get('ding_sync_stats', Counter())
+        # snapshot of a full sync, applied batches are committed so a failed run resumes from them
+        snapshot = self.env.context.get('ding_snapshot')
+
+        members = {}
+        leaders = {}
+        # Dingtalk department id: hr.department id of departments synced in this run
+        dep_ids = {}
+        semaphore = asyncio.Semaphore(ding_request.max_concurrency)
 
-        dep_ding_id_list = []
-        depart_tree = await self.get_ding_server_depart_tree(
-            auth_scopes['auth_org_scopes']['authed_dept'],
-            lambda dep_id: dep_ding_id_list.append(dep_id)
-        )
+        async def _collect_users(dep, server_dep_id):
+            async with semaphore:
+                leaders[dep.id] = await self.env['hr.employee'].collect_ding_users(dep, server_dep_id, members)
 
+        def _upsert_batch(batch):
+            with timed('orm'):
+                self.upsert_ding_departments(batch, dep_ids)
+                if snapshot is not None:
+                    self.env.cr.commit()
+            for dep_detail in batch:
+                if snapshot is not None:
+                    snapshot.write_department(dep_detail)
+                dep = self.browse(dep_ids[str(dep_detail['dept_id'])])
+                tasks.append(asyncio.ensure_future(_collect_users(dep, dep_detail['dept_id'])))
+
+        # departments are written in batches while discovery goes on, and users of a batch are fetched as soon
+        # as it is written, a department always comes after its parent
         tasks = []
+        batch = []
+        try:
+            async for dep_detail in ding_request.iter_department_tree(
+                    auth_scopes['auth_org_scopes']['authed_dept'], detail_fields=self.ding_detail_fields):
+                # counted here rather than in DingRequest, so departments served from cache are counted too
+                sync_stats['departments_fetched'] += 1
+                batch.append(dep_detail)
+                if len(batch) >= self.ding_upsert_batch_size:
+                    _upsert_batch(batch)
+                    batch = []
+            if batch:
+                _upsert_batch(batch)
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+        # hierarchy fields of all departments are recomputed once
+        with timed('orm'):
+            self.flush_model()
+
+        apply_members = members
+        if snapshot is not None:
+            self.env.cr.commit()
+            apply_members = self._ding_members_to_apply(members, snapshot)
+            sync_stats['employee_skipped'] += len(members) - len(apply_members)
+
+        def _on_batch(last_unionid):
+            self.env.cr.commit()
+            snapshot.update_checkpoint(applied_unionid=last_unionid)
+
+        # a user in many departments is written once with all its departments
+        with timed('orm'):
+            self.env['hr.employee'].upsert_ding_users(apply_members, on_batch=_on_batch if snapshot else None)
+            self.set_ding_managers(leaders)
 
-        # change where the employee in the department status to active = False
-        self.env['hr.employee'].search([('ding_department_ids.ding_id', 'in', dep_ding_id_list)]).write(
-            {'active': False})
+        # records which are not in Dingtalk any more are archived only after the others are applied
+        with timed('orm'):
+            root_ids = [dep_ids[str(dept_id)] for dept_id in auth_scopes['auth_org_scopes']['authed_dept']
+                        if str(dept_id) in dep_ids]
+            self.sweep_ding_records(root_ids, set(dep_ids.values()), set(members))
 
-        async def _sync_dep(_dep_leaf, parent_id):
-            _tasks = []
-            dep_detail = await ding_request.department_detail(_dep_leaf['id'])
+    def _ding_members_to_apply(self, members, snapshot):
+        """
+        members which are not applied by the failed run, and not in unchanged subtrees with employees untouched
+        in odoo since the last successful run
+        :param members: collected members
+        :param snapshot: OrgSnapshot of the run
+        :return: dict of unionid: member
+        """
+        applied_unionid = snapshot.checkpoint.get('applied_unionid')
+        unchanged = snapshot.unchanged_departments() if self.ding_skip_unchanged else set()
+        skipped = {
+            unionid for unionid, member in members.items()
+            if unchanged and all(str(dept_id) in unchanged for dept_id in member['user']['dept_id_list'])
+        }
+        if skipped:
+            skipped = self._ding_untouched_unionids(skipped, snapshot.read_last_finished())
+        return {
+            unionid: member for unionid, member in members.items()
+            if not (applied_unionid and unionid <= applied_unionid) and unionid not in skipped
+        }
 
-            dep = self.search([('ding_id', '=', dep_detail['dept_id'])])
-            # dep need commit to db because sync user need use it
-            modify_data = {
-                'company_id': ding_app.company_id.id,
-                'name': dep_detail['name'],
-                'ding_id': dep_detail['dept_id'],
-                'ding_parent_id': dep_detail.get('parent_id', None),  # root department has no parent_id
-                'parent_id': parent_id,
-                'ding_order': dep_detail['order'],
-                'manager_id': False
-            }
+    def _ding_untouched_unionids(self, unionids, finished):
+        """
+        unionids whose employee and user are not written since finished, so they still match the last snapshot,
+        an employee edited in odoo, or missing its user while the app syncs users, is applied again
+        :param unionids: set of unionid
+        :param finished: timestamp the last successful run finished
+        :return: set of unionid
+        """
+        if not finished:
+            return set()
+        ding_app = self.env.context.get('ding_app')
+        # write_date is naive utc
+        finished = datetime.datetime.fromtimestamp(finished, datetime.timezone.utc).replace(tzinfo=None)
+        employees = self.env['hr.employee'].ding_resolve(unionids=list(unionids), company_id=ding_app.company_id.id)
+        return {
+            employee.ding_id for employee in employees
+            if employee.write_date <= finished and (
+                employee.user_id.write_date <= finished if employee.user_id else not ding_app.sync_with_user)
+        }
 
-            if dep.id is False:
-                dep = self.create(modify_data)
-            else:
-                dep.write(modify_data)
+    def sweep_ding_records(self, root_ids, seen_department_ids, seen_unionids):
+        """
+        archive departments under root_ids and their employees which are not seen in the sync,
+        users of archived employees are archived too if the app syncs users
+        :param root_ids: hr.department ids of the synced root departments
+        :param seen_department_ids: set of hr.department id synced
+        :param seen_unionids: set of unionid synced
+        :return:
+        """
+        ding_app = self.env.context.get('ding_app')
+        sync_stats = self.env.context.get('ding_sync_stats', Counter())
 
-            await self.env['hr.employee'].sync_ding_user(dep, dep_detail['dept_id'])
+        covered_ids = set(self.search([('id', 'child_of', root_ids), ('ding_id', '!=', False)]).ids) \
+            if root_ids else set()
+        missing_departments = self.browse(list(covered_ids - seen_department_ids))
 
-            if len(_dep_leaf['children']) > 0:
-                for child in _dep_leaf['children']:
-                    _tasks.append(_sync_dep(child, dep.id))
-                await asyncio.gather(*_tasks)
+        # employees are archived first, departments of them are still active to be matched
+        covered_ids |= seen_department_ids
+        missing_employees = self.env['hr.employee'].search([
+            ('ding_id', '!=', False),
+            ('company_id', '=', ding_app.company_id.id),
+            ('ding_department_ids', 'in', list(covered_ids))
+        ]).filtered(lambda employee: employee.ding_id not in seen_unionids)
+        if ding_app.sync_with_user:
+            missing_employees.user_id.write({'active': False})
+        missing_employees.write({'active': False})
+        missing_departments.write({'active': False})
+        sync_stats['employee_archived'] += len(missing_employees)
+        sync_stats['department_archived'] += len(missing_departments)
 
-        for dep_leaf in depart_tree:
-            tasks.append(_sync_dep(dep_leaf, False))
+    def set_ding_managers(self, leaders):
+        """
+        set department managers, only changed managers are written, and employees of the departments who have
+        no manager or still report to the previous manager are set to the department manager
+        :param leaders: dict of hr.department id: unionid of leader or None(no manager)
+        :return:
+        """
+        ding_app = self.env.context.get('ding_app')
+        employees = self.env['hr.employee'].ding_resolve_ids(
+            'unionid', [unionid for unionid in leaders.values() if unionid], ding_app and ding_app.company_id.id)
+        departments = self.browse(list(leaders))
+        previous_managers = {}
+        for dep in departments:
+            manager_id = employees.get(leaders[dep.id], False)
+            if dep.manager_id.id != manager_id:
+                previous_managers[dep.id] = dep.manager_id.id
+                dep.write({'manager_id': manager_id})
+
+        # parent_id is only computed when manager changes, so an employee whose manager was cleared is repaired
+        # here, a manager set by hand is kept and the manager never reports to itself, like _update_employee_manager
+        managed = departments.filtered('manager_id')
+        candidates = self.env['hr.employee'].search([
+            ('department_id', 'in', managed.ids),
+            ('parent_id', 'in', [False] + [manager_id for manager_id in previous_managers.values() if manager_id])
+        ])
+        stale = {}
+        for employee in candidates:
+            dep = employee.department_id
+            if employee != dep.manager_id and employee.parent_id.id in (False, previous_managers.get(dep.id, False)):
+                stale.setdefault(dep.manager_id.id, self.env['hr.employee'])
+                stale[dep.manager_id.id] |= employee
+        for manager_id, stale_employees in stale.items():
+            stale_employees.write({'parent_id': manager_id})
 
-        await asyncio.gather(*tasks)
+    def _sync_ding_department_ids(self, dept_ids):
+        """
+        fetch departments by Dingtalk ids and upsert them, parent is applied before its children,
+        only the fetch runs in the event loop, records are written in the calling thread
+        :param dept_ids: department id list in Dingtalk
+        :return:
+        """
+        ding_app = self.env.context.get('ding_app')
+        # cached details are stale after the event, and parent of a moved department is unknown,
+        # so all cached sub department lists are removed
+        ding_request = ding_app.get_ding_request()
+        ding_request.invalidate_cache('department_detail', *dept_ids)
+        ding_request.invalidate_cache('department_listsubid')
+        ding_request.invalidate_cache('department_listsub')
+        with_positions = 'order' not in self.ding_detail_fields
+
+        async def _fetch(ding_request):
+            results = await asyncio.gather(*[ding_request.department_detail(dept_id) for dept_id in dept_ids],
+                                           return_exceptions=True)
+            # a department removed since the event is skipped, its remove event archives it
+            details = []
+            for result in results:
+                if isinstance(result, BaseException) and not is_not_found(result):
+                    raise result
+                if not isinstance(result, BaseException):
+                    details.append(result)
+            return await self._ding_with_positions(ding_request, details) if with_positions else details
+
+        details = ding_app.ding_run(_fetch)
+        dep_ids = self.ding_resolve_ids([detail['parent_id'] for detail in details if detail.get('parent_id')],
+                                        ding_app.company_id.id)
+        self.upsert_ding_departments(details, dep_ids)
+
+    @staticmethod
+    async def _ding_with_positions(ding_request, details):
+        """
+        replace order of department details by their position in the listing of their parent, the same as sync
+        :param ding_request: DingRequest
+        :param details: department details
+        :return: department details with position
+        """
+        parent_ids = list({detail['parent_id'] for detail in details if detail.get('parent_id')})
+        listings = await asyncio.gather(*[ding_request.department_listsub(parent_id) for parent_id in parent_ids])
+        positions = {str(child['dept_id']): position for listing in listings
+                     for position, child in enumerate(listing)}
+        return [dict({key: value for key, value in detail.items() if key != 'order'},
+                     position=positions[str(detail['dept_id'])])
+                if str(detail['dept_id']) in positions else detail for detail in details]
 
     def on_ding_org_dept_create(self, content, app):
-        pass
+        self.sudo().with_context(ding_app=app)._sync_ding_department_ids(content['DeptId'])
 
     def on_ding_org_dept_modify(self, content, app):
-        pass
+        # a moved department is re-parented by the parent_id in its detail
+        self.on_ding_org_dept_create(content, app)
 
     def on_ding_org_dept_remove(self, content, app):
-        pass
+        ding_request = app.get_ding_request()
+        ding_request.invalidate_cache('department_detail', *content['DeptId'])
+        ding_request.invalidate_cache('department_listsubid')
+        ding_request.invalidate_cache('department_listsub')
+        self.sudo().ding_resolve(content['DeptId'], app.company_id.id).write({'active': False})
@@ -1,8 +1,10 @@
 import asyncio
+from collections import Counter
 
 from odoo import models, fields, api, _
 from odoo.exceptions import UserError
-from ..common.ding_request import ding_request_instance
+from ..common.ding_request import is_not_found
+from ..common.record_diff import diff_vals, group_writes
 
 
 def send_list_to_str(send_list):
@@ -19,119 +21,305 @@ def send_list_to_str(send_list):
 class Employee(models.Model):
     _inherit = 'hr.employee'
 
-    ding_id = fields.Char(string='Dingtalk User unionid ID')
-    ding_userid = fields.Char(string='Dingtalk User ID')
+    ding_id = fields.Char(string='Dingtalk User unionid ID', index=True)
+    ding_userid = fields.Char(string='Dingtalk User ID', index=True)
     ding_department_ids = fields.Many2many('hr.department', 'ding_employee_department_rel', 'employee_id',
                                            'department_id', string='Dingtalk Departments')
     ding_extattr = fields.Json(string='Dingtalk User Extattr')
 
+    _sql_constraints = [
+        ('ding_id_company_uniq', 'unique(ding_id, company_id)', 'Dingtalk user unionid must be unique per company!'),
+        ('ding_userid_company_uniq', 'unique(ding_userid, company_id)',
+         'Dingtalk user userid must be unique per company!')
+    ]
+
+    # seconds to wait for Dingtalk when send message
+    send_message_timeout = 60
+    # res.users created in one create call when sync with user
+    ding_user_create_batch_size = 200
+    # Dingtalk id field of each key of ding_resolve_ids
+    ding_identity_fields = {'unionid': 'ding_id', 'userid': 'ding_userid'}
+
+    @api.model
+    def ding_resolve_ids(self, key, values, company_id=None):
+        """
+        resolve Dingtalk ids to employee ids with one indexed query, archived employees are included
+        :param key: unionid or userid
+        :param values: Dingtalk id list
+        :param company_id: company id, None is all companies
+        :return: dict of Dingtalk id: employee id, ids not found are not included
+        """
+        values = list({value for value in values if value})
+        if not values:
+            return {}
+        field_name = self.ding_identity_fields[key]
+        domain = [(field_name, 'in', values)]
+        if company_id:
+            domain.append(('company_id', '=', company_id))
+        id_map = {}
+        for employee in self.with_context(active_test=False).search_read(domain, [field_name], order='id'):
+            id_map.setdefault(employee[field_name], employee['id'])
+        return id_map
+
+    @api.model
+    def ding_resolve(self, unionids=None, userids=None, company_id=None):
+        """
+        resolve Dingtalk unionid and userid to employees
+        :param unionids: unionid list
+        :param userids: userid list
+        :param company_id: company id, None is all companies
+        :return: hr.employee recordset, archived employees are included
+        """
+        ids = list(self.ding_resolve_ids('unionid', unionids or [], company_id).values()) + \
+            list(self.ding_resolve_ids('userid', userids or [], company_id).values())
+        return self.browse(list(dict.fromkeys(ids)))
+
+    def ding_identities(self):
+        """
+        resolve employees to Dingtalk ids
+        :return: dict of employee id: {'unionid': unionid, 'userid': userid}
+        """
+        return {employee['id']: {'unionid': employee['ding_id'], 'userid': employee['ding_userid']}
+                for employee in self.with_context(active_test=False).read(['ding_id', 'ding_userid'])}
+
     @api.depends('department_id.manager_id')
     def _compute_parent_id(self):
         for employee in self.filtered('department_id.manager_id'):
             employee.parent_id = employee.department_id.manager_id
 
+    def _ding_user_vals(self, val):
+        """
+        res.users vals of employee, val can be partial, missing user info is read from employee
+        :param val: employee vals
+        :return: res.users vals
+        """
+        company_id = val.get('company_id', self.company_id.id)
+        return {
+            'name': val.get('name', self.name),
+            'login': val.get('ding_id', self.ding_id),
+            'company_id': company_id,
+            'company_ids': [(4, company_id)],
+            'active': val.get('active', self.active)
+        }
+
+    @api.model
+    def ding_ensure_users(self, user_vals):
+        """
+        find res.users by login in one query and create the missing ones in batches, found users are not written
+        :param user_vals: list of res.users vals with login
+        :return: dict of login: res.users id
+        """
+        users = self.env['res.users']
+        user_ids = {user.login: user.id for user in users.search(
+            [('login', 'in', list({val['login'] for val in user_vals})), ('active', 'in', [True, False])])}
+        missing = list({val['login']: val for val in user_vals if val['login'] not in user_ids}.values())
+        if missing:
+            # the same groups for all users, so groups of a batch are inserted together
+            groups = [(6, 0, [self.env.ref('base.group_user').id])]
+            users = users.with_context(no_reset_password=True, tracking_disable=True)
+            for i in range(0, len(missing), self.ding_user_create_batch_size):
+                batch = missing[i:i + self.ding_user_create_batch_size]
+                created = users.create([dict(val, groups_id=groups) for val in batch])
+                user_ids.update(zip([val['login'] for val in batch], created.ids))
+        return user_ids
+
     def ding_write_with_user(self, val):
-        if self.user_id.id is False:
-            user = self.env['res.users'].create({
-                'name': val['name'],
-                'login': val['ding_id'],
-                'company_id': val['company_id'],
-                'company_ids': [(4, val['company_id'])],
-                'groups_id': [(6, 0, [self.env.ref('base.group_user').id])],
-                'active': val['active']
-            })
-            val['user_id'] = user.id
-        else:
-            self.user_id.write({
-                'name': val['name'],
-                'active': val['active']
-            })
-        self.write(val)
+        """
+        write employees and their res.users, val can be partial, missing user info is read from employee
+        :param val: employee vals
+        :return:
+        """
+        self.ding_group_write([(self, val)], with_user=True)
+
+    def ding_group_write(self, write_list, with_user=False):
+        """
+        write records which have the same vals together, with_user also creates missing res.users and writes
+        name and active of res.users, res.users which have the same name and active are written together
+        :param write_list: list of (record, vals)
+        :param with_user: write res.users of employees too
+        :return:
+        """
+        user_write_list = []
+        if with_user:
+            employee_write_list = []
+            to_link = []
+            for employees, vals in write_list:
+                with_users = employees.filtered('user_id')
+                user_val = {key: vals[key] for key in ('name', 'active') if key in vals}
+                if with_users and user_val:
+                    user_write_list.append((with_users.user_id, user_val))
+                if with_users and vals:
+                    employee_write_list.append((with_users, vals))
+                to_link.extend((employee, vals) for employee in employees - with_users)
+            if to_link:
+                user_vals = [employee._ding_user_vals(vals) for employee, vals in to_link]
+                user_ids = self.ding_ensure_users(user_vals)
+                employee_write_list.extend((employee, dict(vals, user_id=user_ids[user_val['login']]))
+                                           for (employee, vals), user_val in zip(to_link, user_vals))
+            write_list = employee_write_list
+
+        for records, vals in group_writes(write_list):
+            records.write(vals)
+        for users, vals in group_writes(user_write_list):
+            users.write(vals)
 
     def ding_create_with_user(self, val_list):
+        """
+        create employees with their res.users, res.users are found by login or created in batches
+        :param val_list: employee vals list
+        :return: hr.employee recordset
+        """
+        user_ids = self.ding_ensure_users([self.browse()._ding_user_vals(val) for val in val_list])
         for val in val_list:
-            user = self.env['res.users'].search([('login', '=', val['ding_id']), ('active', 'in', [True, False])])
-            if user.id is False:
-                user = self.env['res.users'].create({
-                    'name': val['name'],
-                    'login': val['ding_id'],
-                    'company_id': val['company_id'],
-                    'company_ids': [(4, val['company_id'])],
-                    'groups_id': [(6, 0, [self.env.ref('base.group_user').id])],
-                    'active': val['active']
-                })
-            val['user_id'] = user.id
+            val['user_id'] = user_ids[val['ding_id']]
         return self.create(val_list)
 
-    async def sync_ding_user(self, ding_department, server_dep_id):
+    async def collect_ding_users(self, ding_department, server_dep_id, members):
+        """
+        read users of a Dingtalk department into members, a user in many departments is collected once
+        with all its departments, so it can be upserted once by upsert_ding_users
+        :param ding_department: hr.department record
+        :param server_dep_id: department id in Dingtalk
+        :param members: dict of unionid: {'user': user info, 'department_ids': set of hr.department id}
+        :return: unionid of the first department leader
+        """
         ding_request = self.env.context.get('ding_request')
+        sync_stats = self.env.context.get('ding_sync_stats', Counter())
+        snapshot = self.env.context.get('ding_snapshot')
+        manager_id = None
+
+        async def _user_pages():
+            # users fetched by the failed run are not fetched again
+            if snapshot is not None and str(server_dep_id) in snapshot.resumed_users:
+                yield snapshot.resumed_users[str(server_dep_id)]
+                return
+            users = []
+            async for page in ding_request.iter_department_users(server_dep_id):
+                users.extend(page)
+                yield page
+            if snapshot is not None:
+                snapshot.write_users(server_dep_id, users)
+
+        # users has multipage, the next page is fetched while the current page is collected
+        async for user_list in _user_pages():
+            for user in user_list:
+                member = members.get(user['unionid'])
+                if member is None:
+                    member = members[user['unionid']] = {'user': user, 'department_ids': set()}
+                    sync_stats['users_collected'] += 1
+                member['department_ids'].add(ding_department.id)
+                # set department manager
+                if user['leader'] == 1 and not manager_id:
+                    manager_id = user['unionid']
+        return manager_id
+
+    async def sync_ding_user(self, ding_department, server_dep_id):
+        """
+        sync users of one Dingtalk department, the department is added to users' departments
+        :param ding_department: hr.department record
+        :param server_dep_id: department id in Dingtalk
+        :return:
+        """
+        members = {}
+        manager_id = await self.collect_ding_users(ding_department, server_dep_id, members)
+        self.upsert_ding_users(members, replace_departments=False)
+        self.env['hr.department'].set_ding_managers({ding_department.id: manager_id})
+
+    def upsert_ding_users(self, members, replace_departments=True, batch_size=500, on_batch=None):
+        """
+        create or write employees of collected members in batches, members are handled in order of unionid
+        :param members: dict of unionid: {'user': user info, 'department_ids': set of hr.department id}
+        :param replace_departments: set departments to the collected ones, otherwise only add them
+        :param batch_size: members handled in one batch
+        :param on_batch: function called with the last unionid of each batch after it is applied
+        :return:
+        """
+        unionids = sorted(members)
+        for i in range(0, len(unionids), batch_size):
+            batch_unionids = unionids[i:i + batch_size]
+            self._upsert_ding_user_batch([members[unionid] for unionid in batch_unionids], replace_departments)
+            if on_batch is not None:
+                on_batch(batch_unionids[-1])
+
+    def _upsert_ding_user_batch(self, member_list, replace_departments=True):
+        """
+        create or write employees of one batch of members
+        :param member_list: list of {'user': user info, 'department_ids': set of hr.department id}
+        :param replace_departments: set departments to the collected ones, otherwise only add them
+        :return:
+        """
         ding_app = self.env.context.get('ding_app')
         sync_with_user = ding_app.sync_with_user
+        sync_stats = self.env.context.get('ding_sync_stats', Counter())
 
-        users = await ding_request.department_users(server_dep_id)
-        # users has multipage, so we need get all users
-        next_cursor = users.get('next_cursor', None)
+        company_id = ding_app.company_id.id
+        create_users = []
+        write_users = []
+        user_list = [member['user'] for member in member_list]
 
-        user_list = users['list']
-        while next_cursor is not None:
-            _users = await ding_request.department_users(server_dep_id, cursor=next_cursor)
-            next_cursor = _users.get('next_cursor', None)
-            user_list.extend(_users['list'])
+        # prefetch jobs, employees and main departments of this batch, one query for each model
+        titles = {user['title'] for user in user_list if user.get('title')}
+        jobs = {job.name: job for job in self.env['hr.job'].search(
+            [('name', 'in', list(titles)), ('company_id', '=', company_id)])}
+        missing_titles = titles - set(jobs)
+        if missing_titles:
+            jobs.update({job.name: job for job in self.env['hr.job'].create([{
+                'name': title,
+                'company_id': company_id
+            } for title in missing_titles])})
 
-        create_users = []
-        manager_id = None
+        employees = {employee.ding_id: employee for employee in self.with_context(active_test=False).ding_resolve(
+            unionids=[user['unionid'] for user in user_list], company_id=company_id)}
+        main_departments = self.env['hr.department'].ding_resolve_ids(
+            {user['dept_id_list'][0] for user in user_list}, company_id)
 
-        for user in user_list:
-            # job
+        for member in member_list:
+            user = member['user']
             title = user.get('title', None)
-            job = self.env['hr.job'].search(
-                [('name', '=', title), ('company_id', '=', ding_app.company_id.id)])
-            if title and job.id is False:
-                job = self.env['hr.job'].create({
-                    'name': title,
-                    'company_id': ding_app.company_id.id
-                })
+            job = jobs.get(title, self.env['hr.job'])
 
             user_id = user['userid']
             unionid = user['unionid']
 
-            employee = self.search([('ding_id', '=', unionid), ('active', 'in', [True, False])])
-            main_department = ding_department.search([('ding_id', '=', user['dept_id_list'][0])])
+            employee = employees.get(unionid)
+            department_ids = sorted(member['department_ids'])
 
             modify_data = {
                 'name': user['name'],
                 'ding_id': unionid,
                 'ding_userid': user_id,
-                'company_id': ding_app.company_id.id,
-                'department_id': main_department.id,
-                'ding_department_ids': [(4, ding_department.id)],
+                'company_id': company_id,
+                'department_id': main_departments.get(str(user['dept_id_list'][0]), False),
+                'ding_department_ids': [(6, 0, department_ids)] if replace_departments else [
+                    (4, dep_id) for dep_id in department_ids],
                 'job_id': job.id,
                 'work_email': user.get('email', None),
                 'mobile_phone': user.get('mobile', None),
                 'ding_extattr': user.get('extension', None),
-                'parent_id': False,
                 'active': user['active']
             }
 
-            if employee.id is False:
+            if employee is None:
                 modify_data['marital'] = False
                 create_users.append(modify_data)
             else:
-                employee.ding_write_with_user(modify_data) if sync_with_user else employee.write(modify_data)
+                changed_data = diff_vals(employee, modify_data)
+                if sync_with_user and employee.user_id:
+                    # res.users name and active are written from employee vals, so force them if user differs
+                    changed_data.update({key: modify_data[key] for key in ('name', 'active')
+                                         if employee.user_id[key] != modify_data[key]})
+                if changed_data or (sync_with_user and not employee.user_id):
+                    write_users.append((employee, changed_data))
+                    sync_stats['employee_updated'] += 1
+                else:
+                    sync_stats['employee_skipped'] += 1
 
-            # set department manager
-            if user['leader'] == 1 and not manager_id:
-                manager_id = unionid
+        self.ding_group_write(write_users, sync_with_user)
 
+        sync_stats['employee_created'] += len(create_users)
         if len(create_users) > 0:
-            # create users limit 500
-            limit = 500
-            for i in range(0, len(create_users), limit):
-                create_vals = create_users[i:i + limit]
-                # if config set not sync user, not create user
-                self.ding_create_with_user(create_vals) if sync_with_user else self.create(create_vals)
-        if manager_id:
-            ding_department.write({'manager_id': self.search([('ding_id', '=', manager_id)]).id})
+            # if config set not sync user, not create user
+            self.ding_create_with_user(create_users) if sync_with_user else self.create(create_users)
 
     def send_ding_message(self, app_id, to_users, to_departments=None, msg=None):
         """
@@ -148,34 +336,105 @@ class Employee(models.Model):
             raise UserError(_('Please select the user or department to send the message!'))
 
         app = self.env['dingtalk.app'].sudo().browse(int(app_id))
-        ding_request = ding_request_instance(app.app_key, app.app_secret)
-
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
 
         userid_list = None if to_users == 'to_all_user' else send_list_to_str(to_users)
         to_all_user = None if to_users != 'to_all_user' else True
 
-        send_message_task = loop.create_task(ding_request.send_message(dict(
+        return app.ding_run(lambda ding_request: ding_request.send_message(dict(
             agentid=app.agentid,
             agent_id=app.agentid,
             userid_list=userid_list,
             to_all_user=to_all_user,
             dept_id_list=send_list_to_str(to_departments),
             msg=msg
-        )))
-        loop.run_until_complete(send_message_task)
-        loop.close()
-        return send_message_task.result()
+        )), self.send_message_timeout)
+
+    def send_ding_message_bulk(self, app_id, msg, departments=None, name=None):
+        """
+        send message to employees of self and departments, recipients are split into api sized tasks,
+        and delivery status of each recipient is recorded in dingtalk.message
+        :param app_id: dingtalk app id used to send message
+        :param msg: message content
+        :param departments: hr.department recordset
+        :param name: message name
+        :return: dingtalk.message record
+        """
+        app = self.env['dingtalk.app'].sudo().browse(int(app_id))
+        return self.env['dingtalk.message'].sudo().send_bulk(app, msg, employees=self, departments=departments,
+                                                             name=name)
+
+    def _sync_ding_userids(self, userids):
+        """
+        fetch users by Dingtalk userid and upsert them with all their departments and leader status,
+        only the fetch runs in the event loop, records are written in the calling thread
+        :param userids: userid list in Dingtalk
+        :return:
+        """
+        ding_app = self.env.context.get('ding_app')
+        # cached user info is stale after the event
+        ding_app.get_ding_request().invalidate_cache('user_info', *userids)
+
+        async def _fetch(ding_request):
+            return await asyncio.gather(*[ding_request.get_user_info_by_userid(userid) for userid in userids],
+                                        return_exceptions=True)
+
+        results = ding_app.ding_run(_fetch)
+        # a user removed since the event is archived, the others are still applied
+        user_list = []
+        removed_userids = []
+        for userid, result in zip(userids, results):
+            if is_not_found(result):
+                removed_userids.append(userid)
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                user_list.append(result)
+        if removed_userids:
+            self.ding_resolve(userids=removed_userids, company_id=ding_app.company_id.id).filtered(
+                'active')._archive_ding_employees(ding_app)
+
+        departments = self.env['hr.department'].ding_resolve_ids(
+            {dept_id for user in user_list for dept_id in user['dept_id_list']}, ding_app.company_id.id)
+        members = {}
+        leaders = {}
+        for user in user_list:
+            members[user['unionid']] = {
+                'user': user,
+                'department_ids': {departments[str(dept_id)] for dept_id in user['dept_id_list']
+                                   if str(dept_id) in departments}
+            }
+            for leader_in_dept in user.get('leader_in_dept', []):
+                dep_id = departments.get(str(leader_in_dept['dept_id']))
+                if dep_id and leader_in_dept['leader']:
+                    leaders[dep_id] = user['unionid']
+        self.upsert_ding_users(members)
+
+        # user who is not leader any more is removed from manager
+        for dep in self.env['hr.department'].search([('manager_id.ding_id', 'in', list(members))]):
+            if dep.id not in leaders and dep.ding_id:
+                leaders[dep.id] = None
+        self.env['hr.department'].set_ding_managers(leaders)
 
     def on_ding_user_add_org(self, content, app):
-        pass
+        self.sudo().with_context(ding_app=app)._sync_ding_userids(content['UserId'])
 
     def on_ding_user_modify_org(self, content, app):
-        pass
+        self.on_ding_user_add_org(content, app)
 
     def on_ding_user_leave_org(self, content, app):
-        pass
+        app.get_ding_request().invalidate_cache('user_info', *content['UserId'])
+        self.sudo().ding_resolve(userids=content['UserId'], company_id=app.company_id.id).filtered(
+            'active')._archive_ding_employees(app)
+
+    def _archive_ding_employees(self, app):
+        """
+        archive employees, and their users if the app syncs users
+        :param app: dingtalk.app record
+        :return:
+        """
+        if app.sync_with_user:
+            self.user_id.write({'active': False})
+        self.write({'active': False})
 
     def on_ding_user_active_org(self, content, app):
-        pass
+        self.on_ding_user_add_org(content, app)
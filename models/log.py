@@ -1,4 +1,4 @@
-from odoo import models, fields
+from odoo import models, fields, api
 
 
 class DingtalkLog(models.Model):
@@ -9,3 +9,78 @@ class DingtalkLog(models.Model):
     company_id = fields.Many2one('res.company', string='Company')
     ding_app_id = fields.Many2one('dingtalk.app', string='Dingtalk App')
     detail = fields.Text(string='Detail')
+
+    # metrics of sync run
+    state = fields.Selection([
+        ('success', 'Success'),
+        ('failed', 'Failed'),
+        ('skipped', 'Skipped')
+    ], string='State')
+    start_time = fields.Datetime(string='Start Time')
+    end_time = fields.Datetime(string='End Time')
+    duration = fields.Float(string='Duration (s)')
+    network_time = fields.Float(string='Network Time (s)', help='Sum of request time, requests run concurrently')
+    orm_time = fields.Float(string='ORM Time (s)')
+    peak_memory = fields.Float(string='Peak Memory (MB)', help='Peak resident memory of the worker process')
+    api_calls = fields.Integer(string='API Calls')
+    api_retries = fields.Integer(string='API Retries')
+    api_throttles = fields.Integer(string='API Throttles')
+    api_errors = fields.Integer(string='API Errors')
+    token_fetches = fields.Integer(string='Token Fetches')
+    cache_hits = fields.Integer(string='Cache Hits')
+    cache_misses = fields.Integer(string='Cache Misses')
+    departments_fetched = fields.Integer(string='Departments Fetched')
+    users_fetched = fields.Integer(string='Users Fetched')
+    department_created = fields.Integer(string='Departments Created')
+    department_updated = fields.Integer(string='Departments Updated')
+    department_skipped = fields.Integer(string='Departments Skipped')
+    department_archived = fields.Integer(string='Departments Archived')
+    employee_created = fields.Integer(string='Employees Created')
+    employee_updated = fields.Integer(string='Employees Updated')
+    employee_skipped = fields.Integer(string='Employees Skipped')
+    employee_archived = fields.Integer(string='Employees Archived')
+    endpoint_ids = fields.One2many('dingtalk.log.endpoint', 'log_id', string='Endpoints')
+
+    @api.model
+    def create_from_metrics(self, app, metrics, state, start_time, detail=None):
+        """
+        create log of a sync run
+        :param app: dingtalk.app record
+        :param metrics: SyncMetrics of the run
+        :param state: success or failed
+        :param start_time: datetime the run starts
+        :param detail: text detail, such as traceback
+        :return: dingtalk.log record
+        """
+        summary = metrics.summary()
+        endpoints = summary.pop('endpoints')
+        vals = {name: value for name, value in summary.items() if name in self._fields}
+        vals.update({
+            'company_id': app.company_id.id,
+            'ding_app_id': app.id,
+            'state': state,
+            'start_time': start_time,
+            'end_time': fields.Datetime.now(),
+            'detail': detail,
+            'endpoint_ids': [(0, 0, endpoint) for endpoint in endpoints]
+        })
+        return self.create(vals)
+
+
+class DingtalkLogEndpoint(models.Model):
+    """
+    api latency of each endpoint in a sync run
+    """
+    _name = 'dingtalk.log.endpoint'
+    _description = 'Dingtalk Log Endpoint'
+    _order = 'total desc'
+
+    log_id = fields.Many2one('dingtalk.log', string='Log', required=True, ondelete='cascade', index=True)
+    endpoint = fields.Char(string='Endpoint', required=True)
+    calls = fields.Integer(string='Calls')
+    errors = fields.Integer(string='Errors', help='Failed and throttled requests')
+    p50 = fields.Float(string='P50 (ms)')
+    p90 = fields.Float(string='P90 (ms)')
+    p99 = fields.Float(string='P99 (ms)')
+    max_latency = fields.Float(string='Max (ms)')
+    total = fields.Float(string='Total (s)')
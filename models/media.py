@@ -0,0 +1,98 @@
+import datetime
+import hashlib
+import os
+
+from odoo import models, fields, api
+
+
+def file_sha1(path, chunk_size=1024 * 1024):
+    """
+    sha1 of file, file is read in chunks
+    :param path: file path
+    :param chunk_size: bytes read each time
+    :return: hex digest
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class Media(models.Model):
+    """
+    uploaded Dingtalk media, media_id is reused by content hash until it expires
+    """
+    _name = 'dingtalk.media'
+    _description = 'Dingtalk Media'
+    _order = 'id desc'
+
+    ding_app_id = fields.Many2one('dingtalk.app', string='Dingtalk App', required=True, ondelete='cascade')
+    checksum = fields.Char(string='Checksum', required=True)
+    media_type = fields.Selection([
+        ('image', 'Image'),
+        ('voice', 'Voice'),
+        ('video', 'Video'),
+        ('file', 'File')
+    ], string='Media Type', required=True)
+    filename = fields.Char(string='Filename')
+    media_id = fields.Char(string='Media ID', required=True)
+    expire_time = fields.Datetime(string='Expire Time', required=True)
+
+    _sql_constraints = [
+        ('media_checksum_uniq', 'unique(ding_app_id, checksum, media_type)',
+         'Media of the same content is uploaded once for each app!')
+    ]
+
+    # media_id is valid for 3 days, it is uploaded again a little earlier
+    media_valid_hours = 70
+
+    @api.model
+    def upload(self, app, media_type, path=None, attachment=None, filename=None):
+        """
+        upload media from file path or ir.attachment, content is streamed from file and media_id of the same
+        content is reused until it expires
+        :param app: dingtalk.app record
+        :param media_type: image, voice, video or file
+        :param path: file path
+        :param attachment: ir.attachment record
+        :param filename: media filename
+        :return: media_id
+        """
+        assert path or attachment, 'path or attachment is required'
+        if attachment:
+            attachment = attachment.sudo()
+            checksum = attachment.checksum
+            filename = filename or attachment.name
+            if attachment.store_fname:
+                path = attachment._full_path(attachment.store_fname)
+        else:
+            checksum = file_sha1(path)
+            filename = filename or os.path.basename(path)
+
+        now = fields.Datetime.now()
+        media = self.search([
+            ('ding_app_id', '=', app.id),
+            ('checksum', '=', checksum),
+            ('media_type', '=', media_type)
+        ], limit=1)
+        if media and media.expire_time > now:
+            return media.media_id
+
+        if path:
+            media_id = app.ding_run(lambda ding_request: ding_request.upload_media_file(media_type, path, filename))
+        else:
+            # attachment stored in database has no file to stream
+            media_id = app.ding_run(lambda ding_request: ding_request.upload_media(
+                media_type, attachment.raw, filename))
+
+        vals = {
+            'filename': filename,
+            'media_id': media_id,
+            'expire_time': now + datetime.timedelta(hours=self.media_valid_hours)
+        }
+        if media:
+            media.write(vals)
+        else:
+            self.create(dict(vals, ding_app_id=app.id, checksum=checksum, media_type=media_type))
+        return media_id
@@ -0,0 +1,217 @@
+import asyncio
+import traceback
+
+from odoo import models, fields, api, _
+from odoo.exceptions import UserError
+
+
+class Message(models.Model):
+    """
+    a message sent to many recipients, recipients are split into tasks which fit Dingtalk api limit,
+    and delivery status of each recipient is polled from Dingtalk
+    """
+    _name = 'dingtalk.message'
+    _description = 'Dingtalk Message'
+    _order = 'id desc'
+
+    name = fields.Char(string='Name', required=True)
+    ding_app_id = fields.Many2one('dingtalk.app', string='Dingtalk App', required=True, ondelete='cascade')
+    msg = fields.Json(string='Message Content')
+    state = fields.Selection([
+        ('sending', 'Sending'),
+        ('sent', 'Sent'),
+        ('done', 'Done'),
+        ('failed', 'Failed')
+    ], string='State', default='sending', required=True, index=True)
+    task_ids = fields.One2many('dingtalk.message.task', 'message_id', string='Tasks')
+    recipient_ids = fields.One2many('dingtalk.message.recipient', 'message_id', string='Recipients')
+    recipient_count = fields.Integer(string='Recipient Count')
+
+    # max userid_list and dept_id_list of one asyncsend_v2 call
+    max_users_per_task = 100
+    max_departments_per_task = 20
+    # seconds to wait for Dingtalk when send message
+    send_timeout = 600
+
+    @api.model
+    def send_bulk(self, app, msg, employees=None, departments=None, userids=None, name=None):
+        """
+        send message to any number of recipients, recipients are split into chunks and sent concurrently
+        under the rate limit of app
+        :param app: dingtalk.app record
+        :param msg: message content, reference https://open.dingtalk.com/document/orgapp-server/message-types-and-data-format
+        :param employees: hr.employee recordset
+        :param departments: hr.department recordset, Dingtalk sends to their sub departments too
+        :param userids: Dingtalk userid list
+        :param name: message name
+        :return: dingtalk.message record
+        """
+        departments = (departments or self.env['hr.department']).filtered('ding_id')
+        userids = list(dict.fromkeys(list(userids or []) + [
+            userid for userid in (employees or self.env['hr.employee']).mapped('ding_userid') if userid]))
+        dept_ids = departments.mapped('ding_id')
+        if not userids and not dept_ids:
+            raise UserError(_('Please select the user or department to send the message!'))
+
+        employee_ids = self.env['hr.employee'].ding_resolve_ids('userid', userids, app.company_id.id)
+        # employees reached through departments are tracked as recipients too, users in the list win
+        department_recipients = {}
+        for department in departments:
+            for employee in self.env['hr.employee'].search([
+                ('ding_department_ids', 'child_of', department.id),
+                ('ding_userid', '!=', False),
+                ('company_id', '=', app.company_id.id)
+            ]):
+                if employee.ding_userid not in employee_ids and employee.ding_userid not in department_recipients:
+                    department_recipients[employee.ding_userid] = (employee, department)
+        message = self.create({
+            'name': name or msg.get('msgtype', 'message'),
+            'ding_app_id': app.id,
+            'msg': msg,
+            'recipient_count': len(userids) + len(department_recipients),
+            'task_ids': [(0, 0, {
+                'userids': ','.join(userids[i:i + self.max_users_per_task])
+            }) for i in range(0, len(userids), self.max_users_per_task)] + [(0, 0, {
+                'dept_ids': ','.join(dept_ids[i:i + self.max_departments_per_task])
+            }) for i in range(0, len(dept_ids), self.max_departments_per_task)]
+        })
+        self.env['dingtalk.message.recipient'].create([{
+            'message_id': message.id,
+            'ding_userid': userid,
+            'employee_id': employee_ids.get(userid, False)
+        } for userid in userids] + [{
+            'message_id': message.id,
+            'ding_userid': userid,
+            'employee_id': employee.id,
+            'department_id': department.id
+        } for userid, (employee, department) in department_recipients.items()])
+        message._dispatch()
+        return message
+
+    def _dispatch(self):
+        """
+        send tasks of the message concurrently, failed tasks are recorded and others are still sent
+        :return:
+        """
+        self.ensure_one()
+        tasks = self.task_ids.filtered(lambda t: not t.task_id)
+        app = self.ding_app_id
+
+        async def _send(ding_request):
+            return await asyncio.gather(*[ding_request.send_message(dict(
+                agentid=app.agentid,
+                agent_id=app.agentid,
+                userid_list=task.userids or None,
+                dept_id_list=task.dept_ids or None,
+                msg=self.msg
+            )) for task in tasks], return_exceptions=True)
+
+        results = app.ding_run(_send, self.send_timeout)
+        for task, result in zip(tasks, results):
+            if isinstance(result, Exception):
+                task.write({'state': 'failed', 'error': ''.join(traceback.format_exception(
+                    type(result), result, result.__traceback__))})
+            else:
+                task.write({'state': 'sending', 'task_id': str(result['task_id'])})
+        self.write({'state': 'failed' if all(task.state == 'failed' for task in self.task_ids) else 'sent'})
+
+    def action_refresh_result(self):
+        self.filtered(lambda m: m.state == 'sent').task_ids.filtered(lambda t: t.state == 'sending').poll_result()
+
+    @api.model
+    def cron_poll_results(self):
+        self.search([('state', '=', 'sent')]).action_refresh_result()
+
+
+class MessageTask(models.Model):
+    _name = 'dingtalk.message.task'
+    _description = 'Dingtalk Message Task'
+
+    message_id = fields.Many2one('dingtalk.message', string='Message', required=True, ondelete='cascade',
+                                 index=True)
+    task_id = fields.Char(string='Task ID')
+    userids = fields.Text(string='User IDs')
+    dept_ids = fields.Text(string='Department IDs')
+    state = fields.Selection([
+        ('draft', 'Draft'),
+        ('sending', 'Sending'),
+        ('done', 'Done'),
+        ('failed', 'Failed')
+    ], string='State', default='draft', required=True)
+    progress = fields.Integer(string='Progress')
+    error = fields.Text(string='Error')
+
+    # recipient status and the send result list it comes from, later status overrides former one
+    result_status = [
+        ('unread', 'unread_user_id_list'),
+        ('read', 'read_user_id_list'),
+        ('failed', 'failed_user_id_list'),
+        ('forbidden', 'forbidden_user_id_list'),
+        ('invalid', 'invalid_user_id_list'),
+    ]
+
+    def poll_result(self):
+        """
+        poll progress of tasks, result of finished tasks is written to recipients
+        :return:
+        """
+        for message in self.message_id:
+            tasks = self.filtered(lambda t: t.message_id == message and t.task_id)
+            app = message.ding_app_id
+
+            async def _poll(ding_request):
+                progresses = await asyncio.gather(*[ding_request.message_send_progress(
+                    app.agentid, int(task.task_id)) for task in tasks])
+                results = await asyncio.gather(*[ding_request.message_send_result(
+                    app.agentid, int(task.task_id)) if progress['status'] == 2 else asyncio.sleep(0)
+                    for task, progress in zip(tasks, progresses)])
+                return list(zip(progresses, results))
+
+            for task, (progress, result) in zip(tasks, app.ding_run(_poll, message.send_timeout)):
+                if result is None:
+                    task.progress = progress.get('progress_in_percent', 0)
+                    continue
+                task._apply_result(result)
+                task.write({'state': 'done', 'progress': 100})
+            if all(task.state in ('done', 'failed') for task in message.task_ids):
+                message.state = 'done'
+
+    def _apply_result(self, result):
+        """
+        write delivery status of recipients, recipients with the same status are written together
+        :param result: send result of task
+        :return:
+        """
+        self.ensure_one()
+        recipients = {recipient.ding_userid: recipient for recipient in self.message_id.recipient_ids}
+        status_userids = {}
+        for status, key in self.result_status:
+            for userid in result.get(key) or []:
+                status_userids[userid] = status
+        grouped = {}
+        for userid, status in status_userids.items():
+            if userid in recipients:
+                grouped.setdefault(status, self.env['dingtalk.message.recipient'])
+                grouped[status] |= recipients[userid]
+        for status, records in grouped.items():
+            records.write({'status': status})
+
+
+class MessageRecipient(models.Model):
+    _name = 'dingtalk.message.recipient'
+    _description = 'Dingtalk Message Recipient'
+
+    message_id = fields.Many2one('dingtalk.message', string='Message', required=True, ondelete='cascade',
+                                 index=True)
+    ding_userid = fields.Char(string='Dingtalk User ID', required=True)
+    employee_id = fields.Many2one('hr.employee', string='Employee')
+    department_id = fields.Many2one('hr.department', string='Via Department',
+                                    help='The recipient is reached through the department')
+    status = fields.Selection([
+        ('sent', 'Sent'),
+        ('unread', 'Unread'),
+        ('read', 'Read'),
+        ('failed', 'Failed'),
+        ('forbidden', 'Forbidden'),
+        ('invalid', 'Invalid')
+    ], string='Status', default='sent', required=True, index=True)
@@ -0,0 +1,35 @@
+/** @odoo-module */
+
+import {registry} from "@web/core/registry";
+
+// show progress of organization sync, the notification of an app is replaced by its latest progress
+const dingSyncProgressService = {
+    dependencies: ["bus_service", "notification"],
+
+    start(env, {bus_service, notification}) {
+        const closers = {};
+
+        bus_service.addEventListener("notification", ({detail: notifications}) => {
+            for (const {payload, type} of notifications) {
+                if (type !== "dingtalk_sync_progress") {
+                    continue;
+                }
+                if (closers[payload.app_id]) {
+                    closers[payload.app_id]();
+                    delete closers[payload.app_id];
+                }
+                if (payload.done) {
+                    continue;
+                }
+                closers[payload.app_id] = notification.add(
+                    `Departments ${payload.departments_done}/${payload.departments_total}, ` +
+                    `users ${payload.users_done}/${payload.users_total}`,
+                    {title: `Syncing ${payload.app_name}`, type: "info", sticky: true}
+                );
+            }
+        });
+        bus_service.start();
+    },
+};
+
+registry.category("services").add("ding_sync_progress", dingSyncProgressService);